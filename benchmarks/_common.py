@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+
+# helpers shared by the benchmark scripts
+
+import socket, time
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def timed(func, *args, repeat=1, **kwargs):
+    # the best time of repeat calls, with the result of the last
+    times = list()
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(*args, **kwargs)
+        times.append(time.perf_counter() - started)
+    return min(times), result
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+# compares the advisor dropdown payload of sending every name in a region with
+# the server-side search (per keystroke), e.g.
+#   python benchmarks/advisor_search.py --region full --names 200
+
+import argparse, json, os, sys
+import numpy as np
+from _common import timed
+
+
+app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def summarize(times, sizes):
+    return {
+        "p50_ms": np.percentile(times, 50) * 1000,
+        "p99_ms": np.percentile(times, 99) * 1000,
+        "mean_bytes": float(np.mean(sizes)),
+        "max_bytes": int(np.max(sizes)),
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--region", default="full")
+    parser.add_argument("--names", type=int, default=200, help="names to type")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    os.chdir(f"{app_dir}/dashboard")
+    sys.path.insert(0, ".")
+    import app
+
+    names = app.get_names(args.region)
+
+    # every name as an option (what the dropdown used to get on region change)
+    options = [{"label": name, "value": name} for name in names]
+    full_list = {"options": len(options), "bytes": len(json.dumps(options))}
+
+    # type the first few characters of a sample of names, a keystroke at a time
+    rng = np.random.default_rng(args.seed)
+    sample = rng.choice(names, min(args.names, len(names)), replace=False)
+    times, sizes = list(), list()
+    for name in sample:
+        for i in range(1, min(len(name), 8) + 1):
+            seconds, result = timed(app.set_advisors, args.region, name[:i], None)
+            times.append(seconds)
+            sizes.append(len(json.dumps(result)))
+
+    results = {
+        "region": args.region,
+        "names": len(names),
+        "full_list": full_list,
+        "keystrokes": len(times),
+        "search": summarize(times, sizes),
+    }
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+# load test of the table and ECDF callbacks served by gunicorn (with the
+# production profile in dashboard/gunicorn.conf.py) at different worker counts
+#   python benchmarks/dashboard_load.py --workers 1 2 4 --concurrency 16
+
+import argparse, json, os, sqlite3, subprocess, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import requests
+from _common import free_port
+
+
+app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+dashboard_dir = f"{app_dir}/dashboard"
+
+
+def start_server(workers, threads, port, timeout=120):
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "--config",
+            "gunicorn.conf.py",
+            "--workers",
+            str(workers),
+            "--threads",
+            str(threads),
+            "--bind",
+            f"127.0.0.1:{port}",
+            "app:server",
+        ],
+        cwd=dashboard_dir,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+    # wait until every worker could be answering
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with code {process.returncode}")
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/health", timeout=5).ok:
+                return process
+        except requests.ConnectionError:
+            time.sleep(0.05)
+    process.terminate()
+    raise TimeoutError("gunicorn did not start")
+
+
+def callback_request(callback, region, advisor, k, column):
+    inputs = [
+        {"id": "region-select", "property": "value", "value": region},
+        {"id": "advisor-select", "property": "value", "value": advisor},
+        {"id": "slider", "property": "value", "value": k},
+    ]
+    if callback == "table":
+        return {
+            "output": "..table.data...table.columns..",
+            "outputs": [
+                {"id": "table", "property": "data"},
+                {"id": "table", "property": "columns"},
+            ],
+            "inputs": inputs,
+            "changedPropIds": ["slider.value"],
+        }
+    inputs.append({"id": "table", "property": "selected_columns", "value": [column]})
+    return {
+        "output": "ecdf-plot.figure",
+        "outputs": {"id": "ecdf-plot", "property": "figure"},
+        "inputs": inputs,
+        "changedPropIds": ["slider.value"],
+    }
+
+
+def run_load(url, callback, region, names, columns, concurrency, duration, seed):
+    # each client sends requests back to back until the time is up
+    deadline = time.perf_counter() + duration
+    latencies, errors = list(), list()
+    lock = threading.Lock()
+
+    def client(i):
+        rng = np.random.default_rng(seed + i)
+        session = requests.Session()
+        while time.perf_counter() < deadline:
+            payload = callback_request(
+                callback,
+                region,
+                names[rng.integers(len(names))],
+                int(rng.integers(1, 21)),
+                columns[rng.integers(len(columns))],
+            )
+            started = time.perf_counter()
+            r = session.post(f"{url}/_dash-update-component", json=payload)
+            elapsed = time.perf_counter() - started
+            with lock:
+                (latencies if r.ok else errors).append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(client, range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "rps": len(latencies) / elapsed,
+        "p50_ms": np.percentile(latencies, 50) * 1000 if latencies else None,
+        "p99_ms": np.percentile(latencies, 99) * 1000 if latencies else None,
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--region", default="full")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    con = sqlite3.connect(f"{dashboard_dir}/data/advisor_similarity.db")
+    names = [r[0] for r in con.execute(f"select Name from ID_lookup_{args.region}")]
+    columns = ["Total Assets", "Advisor Growth (1y)", "Assets Per Client"]
+    con.close()
+
+    results = list()
+    for workers in args.workers:
+        port = free_port()
+        process = start_server(workers, args.threads, port)
+        try:
+            for callback in ["table", "ecdf"]:
+                result = run_load(
+                    f"http://127.0.0.1:{port}",
+                    callback,
+                    args.region,
+                    names,
+                    columns,
+                    args.concurrency,
+                    args.duration,
+                    args.seed,
+                )
+                result.update(workers=workers, threads=args.threads, callback=callback)
+                results.append(result)
+                print(json.dumps(result), file=sys.stderr)
+        finally:
+            process.terminate()
+            process.wait()
+
+    print(json.dumps(results, indent=2))
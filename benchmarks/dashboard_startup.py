@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+# measures the time from starting a dashboard process to its first responses
+# (the page and the advisor names of a region), e.g.
+#   python benchmarks/dashboard_startup.py --runs 5 --region full
+
+import argparse, json, os, subprocess, sys, time
+import requests
+from _common import free_port
+
+
+app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def wait_for(url, process, timeout=120):
+    # poll until the server answers (or the process dies)
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"dashboard exited with code {process.returncode}")
+        try:
+            return requests.get(url, timeout=5)
+        except requests.ConnectionError:
+            time.sleep(0.01)
+    raise TimeoutError(f"no response from {url} after {timeout}s")
+
+
+def names_request(region):
+    # the callback request the browser sends on load to fill the advisor dropdown
+    return {
+        "output": "advisor-select.options",
+        "outputs": {"id": "advisor-select", "property": "options"},
+        "inputs": [
+            {"id": "region-select", "property": "value", "value": region},
+            {"id": "advisor-select", "property": "search_value", "value": ""},
+        ],
+        "state": [{"id": "advisor-select", "property": "value", "value": ""}],
+        "changedPropIds": ["region-select.value"],
+    }
+
+
+def measure(region, env=None):
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-c", f"from app import app; app.run_server(port={port})"],
+        cwd=f"{app_dir}/dashboard",
+        env={**os.environ, "RIA_PROFILE_STARTUP": "1", **(env or dict())},
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+    try:
+        wait_for(url, process).raise_for_status()
+        page = time.perf_counter() - started
+        r = requests.post(f"{url}/_dash-update-component", json=names_request(region))
+        r.raise_for_status()
+        callback = time.perf_counter() - started
+    finally:
+        process.terminate()
+        output = process.communicate()[0]
+
+    # startup times reported by the app itself
+    result = {"first_page": page, "first_callback": callback}
+    for line in output.splitlines():
+        if line.startswith("startup "):
+            step, ms = line[len("startup ") :].split(": ")
+            result[step] = float(ms.split()[0]) / 1000
+    return result
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--region", default="full")
+    parser.add_argument(
+        "--preload", action="store_true", help="load names and ECDFs at startup"
+    )
+    args = parser.parse_args()
+
+    env = {"RIA_PRELOAD": "1" if args.preload else "0"}
+    runs = [measure(args.region, env) for _ in range(args.runs)]
+    summary = {
+        key: sorted(run[key] for run in runs)[len(runs) // 2] for key in runs[0]
+    }
+    print(json.dumps({"runs": runs, "median": summary}, indent=2))
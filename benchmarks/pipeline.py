@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+# times and memory-profiles the pipeline stages and the dashboard queries on
+# synthetic filings (src/synthetic_data.py) at several scales, e.g.
+#   python benchmarks/pipeline.py --advisers 10000 100000 1000000 --output results.json
+# each scale runs in its own process against its own app directory (RIA_APP_DIR),
+# so that memory peaks of one scale don't carry over to the next
+
+import argparse, json, os, platform, shutil, subprocess, sys, tempfile, time
+import numpy as np
+
+
+app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, app_dir)
+
+from src import profiling
+from src.synthetic_data import write_filings
+
+
+# region and column the dashboard queries are made in
+region = "full"
+column = "Total Assets"
+
+
+def run_pipeline(workers):
+    # imported here since the modules read RIA_APP_DIR when they are imported
+    from src.data_processing import process_data
+    from src.feature_engineering import engineer_features
+    from src.model_building import build_regional_models
+    from src.reporting import create_dashboard_data
+
+    stages = [
+        ("process", process_data, {"workers": workers}),
+        ("engineer", engineer_features, {}),
+        ("models", build_regional_models, {"workers": workers}),
+        ("reporting", create_dashboard_data, {"workers": workers}),
+    ]
+    for name, func, options in stages:
+        with profiling.step(name):
+            func(**options)
+
+
+def time_queries(queries, seed):
+    # the dashboard helpers behind each callback, for a sample of advisers (the
+    # table is queried first, so the ECDF reuses its cached selection just as in
+    # the dashboard)
+    os.chdir(f"{os.environ['RIA_APP_DIR']}/dashboard")
+    sys.path.insert(0, f"{app_dir}/dashboard")
+    import app
+
+    with profiling.step("dashboard"):
+        with profiling.step("names") as record:
+            names = app.get_names(region)
+            record["rows_out"] = len(names)
+
+        rng = np.random.default_rng(seed)
+        sample = rng.choice(names, min(queries, len(names)), replace=False)
+        helpers = {
+            "search": lambda name: app.search_names(region, name[:3]),
+            "table": lambda name: app.main(region, name, 20),
+            "ecdf": lambda name: app.create_ecdf(region, name, 20, column),
+        }
+        for helper, func in helpers.items():
+            with profiling.step(helper, queries=len(sample)) as record:
+                times = list()
+                for name in sample:
+                    started = time.perf_counter()
+                    func(name)
+                    times.append(time.perf_counter() - started)
+                record["p50_ms"] = round(np.percentile(times, 50) * 1000, 3)
+                record["p99_ms"] = round(np.percentile(times, 99) * 1000, 3)
+
+
+def run_scale(path, advisers, args):
+    # generates the filings and runs the benchmark on them in a new process
+    started = time.perf_counter()
+    filings = write_filings(path, advisers, args.years, seed=args.seed)
+    generate_s = round(time.perf_counter() - started, 4)
+
+    report = f"{path}/benchmark.json"
+    command = [sys.executable, os.path.abspath(__file__), "--run", report]
+    command += ["--workers", str(args.workers), "--queries", str(args.queries)]
+    command += ["--seed", str(args.seed)]
+    subprocess.run(command, env={**os.environ, "RIA_APP_DIR": path}, check=True)
+    with open(report) as fh:
+        steps = json.load(fh)["steps"]
+    return {
+        "advisers": advisers,
+        "filings": filings,
+        "generate_s": generate_s,
+        "steps": steps,
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--advisers", type=int, nargs="+", default=[10000, 100000, 1000000]
+    )
+    parser.add_argument("--years", type=int, default=8, help="years of filings")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--queries", type=int, default=200, help="per helper")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="keep the app directories here")
+    parser.add_argument("--output", help="also write the results to a JSON file")
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # a single scale (in the process started by run_scale)
+    if args.run:
+        try:
+            run_pipeline(args.workers)
+            time_queries(args.queries, args.seed)
+        finally:
+            profiling.write_report(args.run)
+        sys.exit()
+
+    workdir = args.workdir or tempfile.mkdtemp()
+    try:
+        scales = [
+            run_scale(f"{workdir}/{advisers}", advisers, args)
+            for advisers in args.advisers
+        ]
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "years": args.years,
+        "workers": args.workers,
+        "queries": args.queries,
+        "seed": args.seed,
+        "scales": scales,
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(results, fh, indent=2)
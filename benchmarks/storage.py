@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+# compares the partitioned Parquet intermediates with the HDF5 files they replaced
+# (write and read time, size on disk, and the projected/filtered reads the
+# pipeline does), e.g.
+#   python benchmarks/storage.py --repeat 3
+
+import argparse, json, os, shutil, sys, tempfile
+import pandas as pd
+from _common import timed
+
+
+app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, app_dir)
+
+from src.reporting import report_cols
+from src.storage import read_frame, write_frame
+
+
+# frame, how it is partitioned and a projected and filtered read of it (the HDF5
+# copies are in table format, since the frames hold categoricals)
+frames = {
+    "selected_data": {
+        "path": "data/processed/selected_data",
+        "partition": {"year_from": "DateSubmitted"},
+        "columns": ["1D", "DateSubmitted", "5F2c"],
+        "filters": None,
+    },
+    "reporting_data": {
+        "path": "data/reporting/reporting_data",
+        "partition": {"partition_cols": ["region"]},
+        "columns": report_cols + ["region"],
+        "filters": [("region", "=", "Mideast")],
+    },
+    "unscaled_features": {
+        "path": "data/engineered/unscaled_features",
+        "partition": {"partition_cols": ["region"]},
+        "columns": None,
+        "filters": [("region", "=", "Mideast")],
+    },
+}
+
+
+def disk_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(root, f))
+        for root, _, files in os.walk(path)
+        for f in files
+    )
+
+
+def read_hdf_subset(path, columns, filters):
+    # the HDF5 files can only be read whole and narrowed afterwards
+    df = pd.read_hdf(path)
+    if filters is not None:
+        for col, _, value in filters:
+            df = df.loc[df[col] == value, :]
+    return df if columns is None else df[columns]
+
+
+def compare(name, spec, tmp, repeat):
+    df = read_frame(f"{app_dir}/{spec['path']}")
+    hdf = f"{tmp}/{name}.h5"
+    parquet = f"{tmp}/{name}"
+
+    hdf_write, _ = timed(df.to_hdf, hdf, "df", format="table", repeat=repeat)
+    parquet_write, _ = timed(
+        write_frame, df, parquet, repeat=repeat, **spec["partition"]
+    )
+    hdf_read, from_hdf = timed(pd.read_hdf, hdf, repeat=repeat)
+    parquet_read, from_parquet = timed(read_frame, parquet, repeat=repeat)
+    if not from_parquet.equals(df) or not from_hdf.equals(df):
+        raise ValueError(f"{name} did not round-trip")
+
+    columns, filters = spec["columns"], spec["filters"]
+    hdf_subset, _ = timed(read_hdf_subset, hdf, columns, filters, repeat=repeat)
+    parquet_subset, subset = timed(
+        read_frame, parquet, columns=columns, filters=filters, repeat=repeat
+    )
+    return {
+        "rows": len(df),
+        "columns": df.shape[1],
+        "hdf": {
+            "write_s": round(hdf_write, 4),
+            "read_s": round(hdf_read, 4),
+            "subset_read_s": round(hdf_subset, 4),
+            "bytes": disk_size(hdf),
+        },
+        "parquet": {
+            "write_s": round(parquet_write, 4),
+            "read_s": round(parquet_read, 4),
+            "subset_read_s": round(parquet_subset, 4),
+            "bytes": disk_size(parquet),
+        },
+        "subset": {
+            "columns": len(subset.columns),
+            "filters": filters,
+            "rows": len(subset),
+        },
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3, help="best of n runs")
+    parser.add_argument("--output", help="also write the results to a JSON file")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        results = {
+            name: compare(name, spec, tmp, args.repeat)
+            for name, spec in frames.items()
+        }
+    finally:
+        shutil.rmtree(tmp)
+
+    print(json.dumps(results, indent=2, default=str))
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(results, fh, indent=2, default=str)
@@ -1,68 +1,204 @@
 # -*- coding: utf-8 -*-
 
-from dash import Dash, html, dcc, dash_table, Input, Output
+import os
+import re
+import time
+
+started = time.perf_counter()
+
+from dash import Dash, html, dcc, dash_table, Input, Output, State
 import dash.dash_table.FormatTemplate as FormatTemplate
 from dash.dash_table.Format import Format, Scheme
 import plotly.graph_objects as go
-import plotly.express as px
-import pandas as pd
+import plotly.io as pio
 import numpy as np
 import sqlite3 as db
+import threading
+from collections import OrderedDict, namedtuple
+
+# set RIA_PROFILE_STARTUP=1 to report import and initialization times, and
+# RIA_PRELOAD=1 to load the advisor names and ECDFs of every region at startup
+# (with gunicorn.conf.py this happens once, before the workers are forked)
+profile_startup = os.environ.get("RIA_PROFILE_STARTUP", "0") == "1"
+preload = os.environ.get("RIA_PRELOAD", "0") == "1"
+
+# size (entries) and time to live (seconds) of the cache shared by the callbacks
+cache_size = int(os.environ.get("RIA_CACHE_SIZE", 1024))
+cache_ttl = float(os.environ.get("RIA_CACHE_TTL", 3600))
+startup_times = {"imports": time.perf_counter() - started}
 
 db_location = "data/advisor_similarity.db"
 
+region_options = [
+    {"label": "All Regions", "value": "full"},
+    {"label": "New England", "value": "NewEngland"},
+    {"label": "Mid East", "value": "Mideast"},
+    {"label": "Southeast", "value": "Southeast"},
+    {"label": "Great Lakes", "value": "GreatLakes"},
+    {"label": "Plains", "value": "Plains"},
+    {"label": "Rocky Mountains", "value": "RockyMountain"},
+    {"label": "Southwest", "value": "Southwest"},
+    {"label": "Far West", "value": "FarWest"},
+    {"label": "Foreign", "value": "Foreign"},
+]
+regions = [option["value"] for option in region_options]
+
+# read-only connections are pooled per thread and reused across callbacks (but
+# not by a forked worker process, since SQLite connections can't cross a fork)
+connections = threading.local()
+
+
+def get_connection():
+    con = getattr(connections, "con", None)
+    if con is None or connections.pid != os.getpid():
+        con = db.connect(
+            f"file:{db_location}?mode=ro", uri=True, check_same_thread=False
+        )
+        connections.con = con
+        connections.pid = os.getpid()
+    return con
+
+
+def region_table(prefix, region):
+    # table names can't be query parameters so regions are checked instead
+    if region not in regions:
+        raise ValueError(f"unknown region: {region}")
+    return f"{prefix}_{region}"
+
+
+def fetch_records(query, params=()):
+    # rows as dicts keyed by column (queries are small enough not to need pandas)
+    cursor = get_connection().execute(query, params)
+    names = [d[0] for d in cursor.description]
+    return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+
+# least recently used query results, shared by the callbacks (and threads);
+# entries expire after cache_ttl seconds and everything is dropped (along with
+# the advisor names) when the database file changes
+cache = OrderedDict()
+cache_lock = threading.Lock()
+cache_mtime = None
+
+
+def check_database():
+    global cache_mtime
+    mtime = os.path.getmtime(db_location)
+    with cache_lock:
+        if mtime != cache_mtime:
+            cache.clear()
+            names_cache.clear()
+            preloaded.clear()
+            cache_mtime = mtime
+
+
+def memoize(key, func, *args):
+    check_database()
+    now = time.monotonic()
+    with cache_lock:
+        if key in cache and now - cache[key][0] < cache_ttl:
+            cache.move_to_end(key)
+            return cache[key][1]
+
+    result = func(*args)
+    with cache_lock:
+        cache[key] = (now, result)
+        cache.move_to_end(key)
+        while len(cache) > cache_size:
+            cache.popitem(last=False)
+    return result
+
+
+# advisor names of each region, loaded on first use
+names_cache = dict()
+
+# ECDFs loaded at startup (outside of the cache so they are never evicted)
+preloaded = dict()
+
 
 def get_names(region):
-    con = db.connect(db_location)
-    query = f"""
-        select * from ID_lookup_{region}
-    """
-    lookup = pd.read_sql(query, con)
-    con.close()
-    return lookup["Name"].tolist()
+    check_database()
+    if region not in names_cache:
+        query = f"""
+            select Name from {region_table("ID_lookup", region)}
+        """
+        names_cache[region] = [row[0] for row in get_connection().execute(query)]
+    return names_cache[region]
+
+
+# most advisor names sent to the dropdown at a time
+search_limit = 50
+
+
+def search_names(region, search):
+    # names with a word starting with each word of the search (the words of every
+    # name are indexed by create_dashboard_data)
+    words = re.findall(r"\w+", search.lower())
+    if len(words) == 0:
+        return list()
+    table = region_table("name_search", region)
+    query = " intersect ".join(
+        [f"select distinct Name from {table} where word >= ? and word < ?"] * len(words)
+    )
+    params = list()
+    for word in words:
+        params.extend([word, word + "\U0010ffff"])
+    query = f"{query} order by Name limit ?"
+    rows = get_connection().execute(query, params + [search_limit]).fetchall()
+    return [row[0] for row in rows]
 
 
 def get_ID(region, name):
-    con = db.connect(db_location)
     query = f"""
-        select * from ID_lookup_{region} where Name = '{name}'
+        select ID from {region_table("ID_lookup", region)} where Name = ?
     """
-    lookup = pd.read_sql(query, con)
-    con.close()
-    return lookup["ID"].values[0]
+    return get_connection().execute(query, (name,)).fetchone()[0]
 
 
-def get_neighbors(region, id_, k):
-    con = db.connect(db_location)
-    query = f"""
-        select * from neighbors_{region} 
-        where ID = '{id_}' and neighbor < {k + 1}
-    """
-    neighbors = pd.read_sql(query, con)
-    con.close()
-    return neighbors
+# an advisor's neighbors (with their data) and the names and data of everyone
+# that can be plotted, fetched once for the most neighbors shown (20) and then
+# sliced by k
+max_k = 20
+Selection = namedtuple("Selection", ["ID", "neighbors", "targets"])
 
 
-def get_neighbors_datatable(region, id_, k):
-    neighbors = get_neighbors(region, id_, k)
-    where_IDs = [f"'{id_}'" for id_ in neighbors["neighbor_ID"]]
-    where_IDs = ",".join(where_IDs)
-    con = db.connect(db_location)
+def load_selection(region, advisor):
+    id_ = get_ID(region, advisor)
     query = f"""
-        select * from reporting_data_formatted
-        where ID in ({where_IDs})
+        select n.neighbor, r.* from {region_table("neighbors", region)} as n
+        join reporting_data_formatted as r on r.ID = n.neighbor_ID
+        where n.ID = ? and n.neighbor < ? order by n.neighbor
     """
-    data = pd.read_sql(query, con)
-    con.close()
-    df = neighbors.merge(data, left_on="neighbor_ID", right_on="ID")
-    df = df.iloc[:, 4:]
-    return df
+    neighbors = list()
+    for record in fetch_records(query, (id_, max_k + 1)):
+        neighbor, neighbor_ID = record.pop("neighbor"), record.pop("ID")
+        neighbors.append((neighbor, neighbor_ID, record))
+
+    # names (from the lookup) and data of the advisor and neighbors
+    IDs = [neighbor_ID for _, neighbor_ID, _ in neighbors] + [id_]
+    where_IDs = ",".join(["?"] * len(IDs))
+    query = f"""
+        select l.Name as lookup_name, r.*
+        from {region_table("ID_lookup", region)} as l
+        join reporting_data_formatted as r on l.ID = r.ID
+        where l.ID in ({where_IDs})
+    """
+    targets = {record["ID"]: record for record in fetch_records(query, IDs)}
+    return Selection(id_, neighbors, targets)
+
+
+def get_selection(region, advisor):
+    return memoize(("selection", region, advisor), load_selection, region, advisor)
+
+
+def get_neighbors(region, advisor, k):
+    selection = get_selection(region, advisor)
+    return [neighbor_ID for n, neighbor_ID, _ in selection.neighbors if n <= k]
 
 
 def main(region, advisor, k):
-    id_ = get_ID(region, advisor)
-    df = get_neighbors_datatable(region, id_, k)
-    return df
+    selection = get_selection(region, advisor)
+    return [record for n, _, record in selection.neighbors if n <= k]
 
 
 xaxis_type = {
@@ -97,64 +233,106 @@ xaxis_type = {
 }
 
 
+blank_layout = dict(xaxis_visible=False, yaxis_visible=False, plot_bgcolor="#fff")
+
+
 def create_blank_fig():
     fig = go.Figure()
-    fig.update_layout(xaxis_visible=False, yaxis_visible=False, plot_bgcolor="#fff")
+    fig.update_layout(**blank_layout)
     return fig
 
 
+def load_ecdf(region, column):
+    # sorted values and percentiles of a column, precomputed by the export
+    query = f"""
+        select x, y, ID from {region_table("ecdf", region)}
+        where "column" = ? order by rowid
+    """
+    rows = get_connection().execute(query, (column,)).fetchall()
+    if len(rows) == 0:
+        return np.array([]), np.array([]), np.array([], dtype=object)
+    x, y, ids = zip(*rows)
+    return np.array(x, dtype=float), np.array(y), np.array(ids, dtype=object)
+
+
+def get_ecdf(region, column):
+    if (region, column) in preloaded:
+        return preloaded[(region, column)]
+    return memoize(("ecdf", region, column), load_ecdf, region, column)
+
+
+def preload_data():
+    # serializing a figure imports plotly's JSON encoder, which it otherwise
+    # does lazily (and not thread-safely) on the first requests
+    pio.to_json(create_blank_fig())
+
+    check_database()
+    for region in regions:
+        get_names(region)
+        for column in cols:
+            if col_selectable[column]:
+                preloaded[(region, column)] = load_ecdf(region, column)
+
+
+def locate(x, ids, targets):
+    # binary search for the position of each (ID, value) target in the ecdf
+    positions = list()
+    for id_, value in targets:
+        lo = np.searchsorted(x, value, side="left")
+        hi = np.searchsorted(x, value, side="right")
+        positions.extend(lo + np.flatnonzero(ids[lo:hi] == id_))
+    return np.sort(np.array(positions, dtype=int))
+
+
 def create_ecdf(region, advisor, k, column):
     if advisor == "" or advisor == None or column == None:
         return create_blank_fig()
     else:
-        # filter by region
-        con = db.connect(db_location)
-        region_filter = pd.read_sql(f"select * from ID_lookup_{region}", con)
-        data = pd.read_sql(f'select ID, "{column}" from reporting_data_formatted', con)
-        con.close()
-        data = region_filter.merge(data, on="ID")
-
-        # identify neighbors to advisor
-        id_ = get_ID(region, advisor)
-        neighbors = get_neighbors(region, id_, k)
-        neighbors = neighbors.loc[:, ["neighbor_ID", "neighbor"]]
-        neighbors = neighbors.rename(columns={"neighbor_ID": "ID"})
-        neighbors["neighbor"] = True
-        data = data.merge(neighbors, how="left", on="ID")
-        data["neighbor"] = data["neighbor"].fillna(False)
-
-        # drop na and inf records in column
-        data = data.loc[~data[column].isin([np.nan, np.inf, -np.inf]), :]
+        if column not in col_types:
+            raise ValueError(f"unknown column: {column}")
+        x, y, ids = get_ecdf(region, column)
+        if len(x) == 0:
+            return create_blank_fig()
+
+        # identify neighbors to advisor (and their names and values)
+        selection = get_selection(region, advisor)
+        id_ = selection.ID
+        neighbors = get_neighbors(region, advisor, k)
+        names = dict()
+        values = list()
+        for target in set(neighbors + [id_]):
+            record = selection.targets.get(target)
+            if record is None or record[column] is None:
+                continue
+            if np.isfinite(float(record[column])):
+                names[target] = record["lookup_name"]
+                values.append((target, record[column]))
+
+        values = np.array(values, dtype=object).reshape(-1, 2)
+        target_ids = values[:, 0]
+        is_neighbor = np.isin(target_ids, neighbors)
+        neighbor_pos = locate(x, ids, values[is_neighbor])
+        advisor_pos = locate(x, ids, values[target_ids == id_])
+        others = neighbor_pos[ids[neighbor_pos] != id_]
 
         # set plot colors
         blue = "#1EAEDB"
         red = "#DB4B1E"
         dark_blue = "#157998"
 
-        # create ecdf plot (remove hover labels)
-        fig = px.ecdf(
-            data,
-            x=column,
-            markers=True,
-            lines=False,
-            ecdfnorm="percent",
-            opacity=0.7,
-            hover_name="Name",
-            color_discrete_sequence=[blue],
-        )
-        fig.update_traces(hovertemplate=None, hoverinfo="skip")
-
-        # get the points from the ecdf plot
-        fig_data = fig.data[0]
-        fig_data = pd.DataFrame(
-            {"Name": fig_data["hovertext"], "x": fig_data["x"], "y": fig_data["y"]}
+        # plot the ecdf (remove hover labels)
+        fig = go.Figure(
+            go.Scattergl(
+                x=x,
+                y=y,
+                mode="markers",
+                marker_color=blue,
+                marker_opacity=0.7,
+                hoverinfo="skip",
+                showlegend=False,
+            )
         )
-        fig_data = fig_data.merge(data.loc[:, ["Name", "neighbor"]], on="Name")
-
-        # plot points for neighbors
-        neighbors_data = fig_data.loc[
-            (fig_data["neighbor"]) & (fig_data["Name"] != advisor), :
-        ]
+        fig.update_layout(yaxis_rangemode="tozero", margin_t=60)
 
         hovertemplate = (
             "<b>%{hovertext}</b><br><br>"
@@ -162,13 +340,14 @@ def create_ecdf(region, advisor, k, column):
             + "=%{x}<br>Percentile=%{y}<extra></extra>"
         )
 
+        # plot points for neighbors
         fig.add_trace(
             go.Scattergl(
-                x=neighbors_data["x"].values,
-                y=neighbors_data["y"].values,
+                x=x[others],
+                y=y[others],
                 hoverlabel=dict(bgcolor=red),
                 hoverinfo="text",
-                hovertext=neighbors_data["Name"].values,
+                hovertext=[names[i] for i in ids[others]],
                 hovertemplate=hovertemplate,
                 mode="markers",
                 marker_color=red,
@@ -180,16 +359,13 @@ def create_ecdf(region, advisor, k, column):
         )
 
         # plot advisor as a star
-        # plot points for neighbors
-        advisor_data = fig_data.loc[fig_data["Name"] == advisor, :]
-
         fig.add_trace(
             go.Scattergl(
-                x=advisor_data["x"].values,
-                y=advisor_data["y"].values,
+                x=x[advisor_pos],
+                y=y[advisor_pos],
                 hoverlabel=dict(bgcolor=dark_blue),
                 hoverinfo="text",
-                hovertext=advisor_data["Name"].values,
+                hovertext=[names[i] for i in ids[advisor_pos]],
                 hovertemplate=hovertemplate,
                 mode="markers",
                 marker_color=dark_blue,
@@ -213,15 +389,18 @@ def create_ecdf(region, advisor, k, column):
         if column == "Discretionary to Total Assets":
             fig.update_xaxes(tickformat=".1%")
         elif xaxis_type[column] == "linear":
-            min_neighbor_y = fig_data.loc[fig_data["neighbor"], "y"].min()
-            max_neighbor_y = fig_data.loc[fig_data["neighbor"], "y"].max()
-            min_clip = fig_data.loc[fig_data["y"] > 1, "x"].min()
-            max_clip = fig_data.loc[fig_data["y"] < 99, "x"].max()
+            # y is increasing, so the clipping points are found by binary search
+            min_neighbor_y = y[neighbor_pos].min() if len(neighbor_pos) else np.nan
+            max_neighbor_y = y[neighbor_pos].max() if len(neighbor_pos) else np.nan
+            lo = np.searchsorted(y, 1, side="right")
+            hi = np.searchsorted(y, 99, side="left") - 1
+            min_clip = x[lo] if lo < len(x) else np.nan
+            max_clip = x[hi] if hi >= 0 else np.nan
 
             if max_neighbor_y >= 99:
-                max_clip = fig_data["x"].max()
+                max_clip = x[-1]
             if min_neighbor_y <= 1:
-                min_clip = fig_data["x"].min()
+                min_clip = x[0]
             fig.update_xaxes(range=[min_clip, max_clip], tickformat=".1%")
         else:
             if column.find("Assets") != -1:
@@ -230,10 +409,8 @@ def create_ecdf(region, advisor, k, column):
         return fig
 
 
-con = db.connect(db_location)
-cols = pd.read_sql("select * from reporting_data_formatted limit 1", con).columns
-cols = cols.tolist()[1:]
-con.close()
+cursor = get_connection().execute("select * from reporting_data_formatted limit 0")
+cols = [d[0] for d in cursor.description][1:]
 
 col_types = {
     "Name": "text",
@@ -420,18 +597,7 @@ app.layout = html.Div(
                     children=[
                         dcc.Dropdown(
                             id="region-select",
-                            options=[
-                                {"label": "All Regions", "value": "full"},
-                                {"label": "New England", "value": "NewEngland"},
-                                {"label": "Mid East", "value": "Mideast"},
-                                {"label": "Southeast", "value": "Southeast"},
-                                {"label": "Great Lakes", "value": "GreatLakes"},
-                                {"label": "Plains", "value": "Plains"},
-                                {"label": "Rocky Mountains", "value": "RockyMountain"},
-                                {"label": "Southwest", "value": "Southwest"},
-                                {"label": "Far West", "value": "FarWest"},
-                                {"label": "Foreign", "value": "Foreign"},
-                            ],
+                            options=region_options,
                             value="full",
                             clearable=False,
                         ),
@@ -486,7 +652,9 @@ app.layout = html.Div(
             children=[
                 html.Div(
                     className="twelve columns",
-                    children=[dcc.Graph(id="ecdf-plot", figure=create_blank_fig())],
+                    children=[
+                        dcc.Graph(id="ecdf-plot", figure={"layout": blank_layout})
+                    ],
                 )
             ],
         ),
@@ -494,9 +662,21 @@ app.layout = html.Div(
 )
 
 
-@app.callback(Output("advisor-select", "options"), [Input("region-select", "value")])
-def set_advisors(region):
-    names = get_names(region)
+@app.callback(
+    Output("advisor-select", "options"),
+    [Input("region-select", "value"), Input("advisor-select", "search_value")],
+    [State("advisor-select", "value")],
+)
+def set_advisors(region, search_value, value):
+    # matches are searched for on the server rather than sending every name
+    if search_value:
+        names = search_names(region, search_value)
+    else:
+        names = get_names(region)[:search_limit]
+
+    # keep the selected advisor as an option so it stays selected
+    if value and value not in names and value in get_names(region):
+        names = [value] + names
     options = [{"label": name, "value": name} for name in names]
     return options
 
@@ -516,8 +696,7 @@ def update_rows(region, advisor, k):
         data = [data]
         # data = [{'column':'Please select or search for an RIA'}]
     else:
-        df = main(region, advisor, k)
-        data = df.to_dict("records")
+        data = main(region, advisor, k)
     columns = datatable_cols
 
     return data, columns
@@ -538,7 +717,28 @@ def update_ecdf(region, advisor, k, column):
     return fig
 
 
+if preload:
+    started_preload = time.perf_counter()
+    preload_data()
+    startup_times["preload"] = time.perf_counter() - started_preload
+
+startup_times["total"] = time.perf_counter() - started
+if profile_startup:
+    for step, seconds in startup_times.items():
+        print(f"startup {step}: {seconds * 1000:.0f} ms")
+
 server = app.server
 
+
+@server.route("/health")
+def health():
+    # for load balancers and uptime checks: the worker is up and can read the data
+    try:
+        get_connection().execute("select 1 from reporting_data_formatted limit 1")
+    except db.Error as e:
+        return {"status": "error", "error": str(e)}, 503
+    return {"status": "ok"}
+
+
 if __name__ == "__main__":
     app.run_server(debug=True)
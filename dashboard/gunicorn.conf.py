@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+# production serving profile: gunicorn --config gunicorn.conf.py app:server
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+
+# worker processes (WEB_CONCURRENCY is set by Heroku for the dyno size) and
+# threads per worker; SQLite connections are per thread
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+threads = int(os.environ.get("RIA_THREADS", 4))
+
+# import the app and load its read-only data once, in the master, so the forked
+# workers share it copy-on-write instead of each loading a copy
+preload_app = True
+os.environ.setdefault("RIA_PRELOAD", "1")
+
+timeout = 60
+accesslog = os.environ.get("RIA_ACCESS_LOG")
@@ -1,14 +1,146 @@
 # -*- coding: utf-8 -*-
 
+import argparse
 
 from src.data_collecting import collect_data
 from src.data_processing import process_data
 from src.feature_engineering import engineer_features
 from src.model_building import build_regional_models
 from src.reporting import create_dashboard_data
+from src.neighbor_indexing import backends
+from src.orchestrating import Stage, run_stages
 
-collect_data()
-process_data()
-engineer_features()
-build_regional_models()
-create_dashboard_data()
\ No newline at end of file
+
+def get_stages(
+    workers=1, incremental=False, backend="exact", mode="regional", index_params=None
+):
+    return [
+        Stage(
+            "collect",
+            collect_data,
+            outputs=["data/raw/SEC/**/*.csv"],
+            cache=False,
+        ),
+        Stage(
+            "process",
+            process_data,
+            inputs=["data/raw/SEC/**/*.csv"],
+            outputs=["data/processed/selected_data/**"],
+            requires=["collect"],
+            options={"workers": workers, "incremental": incremental},
+        ),
+        Stage(
+            "engineer",
+            engineer_features,
+            inputs=["data/processed/selected_data/**"],
+            outputs=[
+                "data/reporting/reporting_data/**",
+                "data/engineered/unscaled_features/**",
+                "data/engineered/clip_limits.npz",
+            ],
+            requires=["process"],
+            options={"incremental": incremental},
+        ),
+        Stage(
+            "models",
+            build_regional_models,
+            inputs=["data/engineered/unscaled_features/**"],
+            outputs=[
+                "data/engineered/*.npy",
+                "models/*.npz",
+                "models/*.pkl",
+                "models/build.json",
+            ],
+            requires=["engineer"],
+            params={"backend": backend, "mode": mode, "index_params": index_params},
+            options={"workers": workers},
+        ),
+        Stage(
+            "reporting",
+            create_dashboard_data,
+            inputs=[
+                "data/reporting/reporting_data/**",
+                "data/engineered/*.npy",
+                "models/*.npz",
+                "models/*.pkl",
+                "models/build.json",
+            ],
+            outputs=["dashboard/data/advisor_similarity.db"],
+            requires=["engineer", "models"],
+            params={"backend": backend, "mode": mode},
+            options={"workers": workers},
+        ),
+    ]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Build the RIA similarity data.")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of workers used to read the raw files and to build and export "
+        "the regional models",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only process new filings and resample advisors whose filings changed",
+    )
+    parser.add_argument(
+        "--backend",
+        default="exact",
+        choices=list(backends),
+        help="nearest neighbor index used for the exported neighbors",
+    )
+    parser.add_argument(
+        "--n-lists",
+        type=int,
+        help="inverted lists of the ivf index (default: the square root of the rows)",
+    )
+    parser.add_argument(
+        "--n-probe",
+        type=int,
+        help="lists the ivf index searches per query (default: 8)",
+    )
+    parser.add_argument(
+        "--global-index",
+        action="store_true",
+        help="build one model over all advisors and filter it by region",
+    )
+    parser.add_argument(
+        "--from",
+        dest="start",
+        metavar="STAGE",
+        help="run this stage and the stages downstream of it",
+    )
+    parser.add_argument(
+        "--only", nargs="+", metavar="STAGE", help="run only these stages"
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="run stages even if they are up to date"
+    )
+    parser.add_argument(
+        "--profile",
+        choices=["cprofile", "pyinstrument"],
+        help="dump a profile of each stage that runs to data/profiles",
+    )
+    args = parser.parse_args()
+
+    mode = "global" if args.global_index else "regional"
+    index_params = {
+        name: value
+        for name, value in [("n_lists", args.n_lists), ("n_probe", args.n_probe)]
+        if value is not None
+    }
+    stages = get_stages(
+        args.workers, args.incremental, args.backend, mode, index_params
+    )
+    run_stages(
+        stages,
+        start=args.start,
+        only=args.only,
+        force=args.force,
+        profiler=args.profile,
+    )
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import pandas as pd
+from src.neighbor_indexing import backends
+from src.reporting import load_region, query_neighbors, region_rows
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+def read_ids(path, column=None):
+    # advisor IDs (SEC numbers, e.g. 801-12345) from a text file with one ID per
+    # line, or from a column of a CSV file
+    if column is None:
+        ids = pd.read_csv(path, header=None, dtype=str, usecols=[0]).iloc[:, 0]
+    else:
+        ids = pd.read_csv(path, dtype=str, usecols=[column])[column]
+    return ids.str.strip().dropna().drop_duplicates().tolist()
+
+
+def split_known(advisor_IDs, region, backend="exact", mode="regional"):
+    # IDs of advisors in the region and the rest; in global mode the full model
+    # is searched, so only its rows in the region count (as in regional mode)
+    model_region = "full" if mode == "global" else region
+    bundle = load_region(model_region, backend)
+    if model_region == region:
+        members = bundle.index
+    else:
+        members = set(bundle.ids[region_rows(bundle, region)])
+    known = [id_ for id_ in advisor_IDs if id_ in members]
+    unknown = [id_ for id_ in advisor_IDs if id_ not in members]
+    return known, unknown
+
+
+def batch_neighbors(
+    advisor_IDs, region, k, backend="exact", mode="regional", chunk_size=1000
+):
+    # yields the k most similar advisors to each advisor (not counting itself),
+    # a chunk of advisors at a time
+    for start in range(0, len(advisor_IDs), chunk_size):
+        chunk = advisor_IDs[start : start + chunk_size]
+        neighbors = query_neighbors(chunk, region, k + 1, backend, mode)
+        neighbors = neighbors.loc[neighbors["neighbor_ID"] != neighbors["ID"], :]
+        neighbors = neighbors.groupby("ID", sort=False).head(k)
+        neighbors = neighbors.assign(
+            neighbor=neighbors.groupby("ID", sort=False).cumcount() + 1
+        )
+        yield neighbors.reset_index(drop=True)
+
+
+def no_neighbors():
+    # the columns of batch_neighbors, for an output without any known advisors
+    return pd.DataFrame(
+        {
+            "ID": pd.Series(dtype=object),
+            "neighbor": pd.Series(dtype="int64"),
+            "neighbor_ID": pd.Series(dtype=object),
+            "distance": pd.Series(dtype="float64"),
+        }
+    )
+
+
+def rank_neighbors(neighbors, exclude=()):
+    # union of the neighbors of every advisor, ranked by how many advisors they
+    # are similar to (and then by their mean distance)
+    neighbors = neighbors.loc[~neighbors["neighbor_ID"].isin(exclude), :]
+    ranked = neighbors.groupby("neighbor_ID").agg(
+        count=("ID", "size"),
+        mean_distance=("distance", "mean"),
+        best_rank=("neighbor", "min"),
+    )
+    ranked = ranked.sort_values(
+        ["count", "mean_distance"], ascending=[False, True]
+    ).reset_index()
+    return ranked
+
+
+class ResultWriter:
+    # appends frames to a CSV or Parquet file (by extension) as they arrive
+    def __init__(self, path):
+        self.path = path
+        self.format = os.path.splitext(path)[1].lower().lstrip(".")
+        if self.format not in ("csv", "parquet"):
+            raise ValueError(f"output must be a .csv or .parquet file: {path}")
+        if self.format == "parquet" and pa is None:
+            raise ImportError("writing Parquet requires pyarrow (pip install pyarrow)")
+        self.writer = None
+        self.rows = 0
+
+    def write(self, df):
+        if self.format == "csv":
+            mode = "a" if self.rows else "w"
+            df.to_csv(self.path, mode=mode, header=not self.rows, index=False)
+        else:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.path, table.schema)
+            self.writer.write_table(table)
+        self.rows += len(df)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def query_batch(
+    advisor_IDs,
+    region,
+    k,
+    output,
+    backend="exact",
+    mode="regional",
+    rank=False,
+    exclude_targets=False,
+    chunk_size=1000,
+):
+    # writes the neighbors of every advisor (or, with rank, the ranked union of
+    # them) to output, returning the IDs that aren't in the region
+    known, unknown = split_known(advisor_IDs, region, backend, mode)
+
+    writer = ResultWriter(output)
+    chunks = batch_neighbors(known, region, k, backend, mode, chunk_size)
+    if len(known) == 0:
+        # (the output is still written, with just the header)
+        chunks = [no_neighbors()]
+    try:
+        if rank:
+            neighbors = pd.concat(list(chunks), ignore_index=True)
+            exclude = known if exclude_targets else ()
+            writer.write(rank_neighbors(neighbors, exclude))
+        else:
+            for neighbors in chunks:
+                writer.write(neighbors)
+    finally:
+        writer.close()
+    return unknown
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Similar advisors for a list of advisors"
+    )
+    parser.add_argument("ids", help="file of advisor IDs (SEC numbers)")
+    parser.add_argument("output", help="results file (.csv or .parquet)")
+    parser.add_argument("--column", help="column of IDs if the file is a CSV")
+    parser.add_argument("--region", default="full")
+    parser.add_argument("-k", type=int, default=20, help="neighbors per advisor")
+    parser.add_argument("--backend", default="exact", choices=list(backends))
+    parser.add_argument("--mode", default="regional", choices=["regional", "global"])
+    parser.add_argument(
+        "--rank",
+        action="store_true",
+        help="write the union of the neighbors ranked by how often they appear",
+    )
+    parser.add_argument(
+        "--exclude-targets",
+        action="store_true",
+        help="leave the listed advisors out of the ranking",
+    )
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    unknown = query_batch(
+        read_ids(args.ids, args.column),
+        args.region,
+        args.k,
+        args.output,
+        backend=args.backend,
+        mode=args.mode,
+        rank=args.rank,
+        exclude_targets=args.exclude_targets,
+        chunk_size=args.chunk_size,
+    )
+    if len(unknown) > 0:
+        print(f"{len(unknown)} IDs not in the {args.region} model, e.g. {unknown[:5]}")
@@ -1,38 +1,91 @@
 # -*- coding: utf-8 -*-
 
-import requests, zipfile, io, os, shutil
+import requests, zipfile, json, os, shutil
+from src.settings import app_dir
 
 
-def dl_and_extract_zip(url, save_to):
-    r = requests.get(url)
-    z = zipfile.ZipFile(io.BytesIO(r.content))
-    z.extractall(save_to)
+sec_url = "https://www.sec.gov/foia/docs/adv/form-adv-complete-ria.zip"
 
 
-def del_unwanted_files(directory, kept_files):
-    dir_files = os.listdir(directory)
-    removed_files = [f for f in dir_files if f not in kept_files]
-    for f in removed_files:
-        os.remove(f"{directory}/{f}")
+def read_meta(path):
+    if os.path.exists(f"{path}.json"):
+        with open(f"{path}.json") as fh:
+            return json.load(fh)
+    return dict()
 
 
-def collect_data():
-    # remove existing files from directory
-    app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+def write_meta(path, meta):
+    with open(f"{path}.json", "w") as fh:
+        json.dump(meta, fh, indent=2)
+
+
+def download_file(url, path, chunk_size=1 << 20, timeout=60):
+    # streams url to path, returning False if the copy on disk is still current
+    meta = read_meta(path)
+    part = f"{path}.part"
+    headers = dict()
+
+    # conditional GET against the last complete download
+    if os.path.exists(path):
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    # resume a partial download, as long as the file hasn't changed since
+    partial = meta.get("partial", dict())
+    validator = partial.get("etag") or partial.get("last_modified")
+    if os.path.exists(part) and os.path.getsize(part) > 0 and validator:
+        headers["Range"] = f"bytes={os.path.getsize(part)}-"
+        headers["If-Range"] = validator
+
+    with requests.get(url, headers=headers, stream=True, timeout=timeout) as r:
+        if r.status_code == 304:
+            return False
+        r.raise_for_status()
+
+        # a server ignoring the range (or a changed file) sends everything again
+        mode = "ab" if r.status_code == 206 else "wb"
+        meta["partial"] = {
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+        }
+        write_meta(path, meta)
+        with open(part, mode) as fh:
+            for chunk in r.iter_content(chunk_size):
+                fh.write(chunk)
+    os.replace(part, path)
+
+    # the validators of the complete download are used for the next request
+    write_meta(path, meta["partial"])
+    return True
+
+
+def extract_members(zip_path, save_to, kept):
+    # only extract the files that are kept (e.g. the Base A questions)
+    with zipfile.ZipFile(zip_path) as z:
+        for member in z.infolist():
+            name = os.path.basename(member.filename)
+            if not member.is_dir() and name.find(kept) > -1:
+                z.extract(member, save_to)
+
+
+def collect_data(url=sec_url):
     sec_dir = f"{app_dir}/data/raw/SEC"
-    dirs = os.listdir(sec_dir)
-    if len(dirs) > 0:
-        for d in dirs:
-            shutil.rmtree(f"{sec_dir}/{d}")
-    # dowload SEC data
-    sec_data = "https://www.sec.gov/foia/docs/adv/form-adv-complete-ria.zip"
-    dl_and_extract_zip(sec_data, sec_dir)
-
-    # remove files that aren't Base A questions
-    zipped_loc = sec_dir + "/" + os.listdir(sec_dir)[0]
-    files = os.listdir(zipped_loc)
-    kept_files = [f for f in files if f.find("IA_ADV_Base_A") > -1]
-    del_unwanted_files(zipped_loc, kept_files)
+    zip_path = f"{app_dir}/data/raw/form-adv-complete-ria.zip"
+
+    # dowload SEC data (nothing to do if the archive hasn't changed)
+    dirs = [d for d in os.listdir(sec_dir) if os.path.isdir(f"{sec_dir}/{d}")]
+    if not download_file(url, zip_path) and len(dirs) > 0:
+        return False
+
+    # remove existing files from directory
+    for d in dirs:
+        shutil.rmtree(f"{sec_dir}/{d}")
+
+    # extract files that are Base A questions
+    extract_members(zip_path, sec_dir, "IA_ADV_Base_A")
+    return True
 
 
 if __name__ == "__main__":
@@ -1,47 +1,139 @@
 # -*- coding: utf-8 -*-
 
 
+import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+from src import profiling
+from src.schema import column_dtypes
+from src.settings import app_dir
+from src.storage import read_frame, write_frame
+import hashlib
+import json
 import os
 import re
 
 
-def create_dataframe_from_raw(path, files):
-    df = pd.DataFrame()
-    for f in tqdm(files):
-        df = df.append(
-            pd.read_csv(f"{path}/{f}", encoding="ISO-8859-1", parse_dates=[2]),
-            ignore_index=True,
-        )
-    return df
+# columns kept from the Base A files
+matches = (
+    r"^1D|1F1-State|^1A|^1B$|^1B1$|"
+    + r"5A-Number|5A$|5B\d-Number|5B\d$|5F2.*|5G\d+$|5H$|DateSubmitted"
+)
+
+
+def select_col_names(cols, matches):
+    return [col for col in cols if len(re.findall(matches, col)) > 0]
+
+
+def read_raw_file(path, f):
+    # resolve the kept columns from the header so only those are parsed
+    header = pd.read_csv(f"{path}/{f}", encoding="ISO-8859-1", nrows=0).columns
+    kept_cols = select_col_names(header, matches)
+
+    # kept columns are parsed straight into their compact dtypes
+    dtypes = column_dtypes(kept_cols, "selected_data")
+    return pd.read_csv(
+        f"{path}/{f}",
+        encoding="ISO-8859-1",
+        usecols=kept_cols,
+        dtype=dtypes,
+        parse_dates=["DateSubmitted"],
+    )
+
+
+def concat_frames(frames):
+    # categoricals only survive concatenation when their categories match
+    categorical_cols = {col for f in frames for col in f.select_dtypes("category")}
+    for col in categorical_cols:
+        cats = union_categoricals([f[col] for f in frames if col in f]).categories
+        for f in frames:
+            if col in f:
+                f[col] = f[col].cat.set_categories(cats)
+    return pd.concat(frames, ignore_index=True)
+
+
+def read_raw_files(path, files, workers=1, pool="thread"):
+    read = partial(read_raw_file, path)
+    if workers > 1:
+        executor = {"thread": ThreadPoolExecutor, "process": ProcessPoolExecutor}
+        with executor[pool](workers) as executor:
+            return list(tqdm(executor.map(read, files), total=len(files)))
+    return [read(f) for f in tqdm(files)]
+
+
+def create_dataframe_from_raw(path, files, workers=1, pool="thread"):
+    return concat_frames(read_raw_files(path, files, workers, pool))
 
 
 def select_cols(df, kept_cols):
     return df.loc[:, kept_cols]
 
 
-def process_data():
+def fingerprint_file(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(partial(fh.read, 1 << 20), b""):
+            sha.update(block)
+    return {"size": os.path.getsize(path), "sha256": sha.hexdigest()}
+
+
+def process_data(workers=1, pool="thread", incremental=False):
     # read in raw data
-    app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     sec_dir = f"{app_dir}/data/raw/SEC"
     adv_dir = sec_dir + "/" + os.listdir(sec_dir)[0]
+    selected = f"{app_dir}/data/processed/selected_data"
+    manifest = f"{app_dir}/data/processed/ingested_files.json"
 
-    # create dataframe
-    files = os.listdir(adv_dir)
-    df = create_dataframe_from_raw(adv_dir, files)
+    # fingerprint the raw files and compare with those already ingested
+    files = sorted(os.listdir(adv_dir))
+    with profiling.step("fingerprint", files=len(files)):
+        fingerprints = {f: fingerprint_file(f"{adv_dir}/{f}") for f in files}
+    ingested = dict()
+    if incremental and os.path.exists(selected) and os.path.exists(manifest):
+        with open(manifest) as fh:
+            ingested = json.load(fh)
 
-    # select columns
-    matches = (
-        r"^1D|1F1-State|^1A|^1B$|^1B1$|"
-        + r"5A-Number|5A$|5B\d-Number|5B\d$|5F2.*|5G\d+$|5H$|DateSubmitted"
-    )
-    cols = df.columns
-    kept_cols = [col for col in cols if len(re.findall(matches, col)) > 0]
-    df = select_cols(df, kept_cols)
+    # the processed rows are in the order of the files they came from, so the
+    # row counts of the manifest locate each file's rows; only new and amended
+    # files are read (manifests without row counts start over)
+    if any("rows" not in fp for fp in ingested.values()):
+        ingested = dict()
+    unchanged = [
+        f
+        for f in files
+        if f in ingested
+        and all(ingested[f][key] == value for key, value in fingerprints[f].items())
+    ]
+    new_files = [f for f in files if f not in unchanged]
+    if len(new_files) == 0 and len(unchanged) == len(ingested):
+        return False
 
-    # save to disk
-    df.to_hdf(f"{app_dir}/data/processed/selected_data.h5", "df")
+    # create dataframe from the selected columns of each new file (columns are
+    # filtered while reading)
+    with profiling.step("csv read", files=len(new_files)) as record:
+        frames = dict(zip(new_files, read_raw_files(adv_dir, new_files, workers, pool)))
+        record["rows_out"] = sum(len(frame) for frame in frames.values())
+    if len(unchanged) > 0:
+        df = read_frame(selected, schema="selected_data")
+        stops = np.cumsum([fp["rows"] for fp in ingested.values()])
+        for f, stop in zip(ingested, stops):
+            if f in unchanged:
+                frames[f] = df.iloc[stop - ingested[f]["rows"] : stop].copy()
+        del df
+    rows = {f: len(frames[f]) for f in files}
+    df = concat_frames([frames.pop(f) for f in files])
+
+    # save to disk (partitioned by filing year)
+    with profiling.step("parquet write", rows_in=len(df)):
+        write_frame(df, selected, year_from="DateSubmitted", schema="selected_data")
+    with open(manifest, "w") as fh:
+        json.dump(
+            {f: {**fingerprints[f], "rows": rows[f]} for f in files}, fh, indent=2
+        )
+    return True
 
 
 if __name__ == "__main__":
@@ -2,18 +2,127 @@
 
 
 import pandas as pd
+from pandas.api.types import is_numeric_dtype
 import re
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 from tqdm import tqdm
 import numpy as np
+import hashlib
 import os
+from src import profiling
+from src.schema import apply_schema
+from src.settings import app_dir
+from src.storage import read_frame, write_frame
 
 
-def engineer_features():
-    # read in processed data
-    app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    df = pd.read_hdf(f"{app_dir}/data/processed/selected_data.h5")
+# setting region based on state (based on Bureau of Economic Analysis regions)
+regions = {
+    "AL": "Southeast",
+    "AK": "FarWest",
+    "AR": "Southeast",
+    "AZ": "Southwest",
+    "CA": "FarWest",
+    "CO": "RockyMountain",
+    "CT": "NewEngland",
+    "DC": "Mideast",
+    "DE": "Mideast",
+    "FL": "Southeast",
+    "GA": "Southeast",
+    "GU": "Foreign",
+    "HI": "FarWest",
+    "IA": "Plains",
+    "ID": "RockyMountain",
+    "IL": "GreatLakes",
+    "IN": "GreatLakes",
+    "KS": "Plains",
+    "KY": "Southeast",
+    "LA": "Southeast",
+    "MA": "NewEngland",
+    "MD": "Mideast",
+    "ME": "NewEngland",
+    "MI": "GreatLakes",
+    "MN": "Plains",
+    "MO": "Plains",
+    "MS": "Southeast",
+    "MT": "RockyMountain",
+    "NC": "Southeast",
+    "ND": "Plains",
+    "NE": "Plains",
+    "NH": "NewEngland",
+    "NJ": "Mideast",
+    "NM": "Southwest",
+    "NV": "FarWest",
+    "NY": "Mideast",
+    "OH": "GreatLakes",
+    "OK": "Southwest",
+    "OR": "FarWest",
+    "PA": "Mideast",
+    "PR": "Foreign",
+    "RI": "NewEngland",
+    "SC": "Southeast",
+    "SD": "Plains",
+    "TN": "Southeast",
+    "TX": "Southwest",
+    "UT": "RockyMountain",
+    "VA": "Southeast",
+    "VI": "Foreign",
+    "VT": "NewEngland",
+    "WA": "FarWest",
+    "WI": "GreatLakes",
+    "WV": "Southeast",
+    "WY": "RockyMountain",
+}
+
+# financial planning clients (5H) ranges, discretized to their lower ends
+planning_clients = {
+    "0": 0,
+    "1-10": 1,
+    "11-25": 11,
+    "26-50": 26,
+    "51-100": 51,
+    "101-250": 101,
+    "251-500": 251,
+    "More than 500": 501,
+}
+
+# columns not being used as features as they are either only for contextual
+# information or derivatives of them have been calculated and used
+not_features = [
+    "DateSubmitted",
+    "1F1-State",
+    "name",
+    "5A",
+    "5B1",
+    "5B2",
+    "5B5",
+    "5F2a",
+    "5F2b",
+    "5F2d",
+    "5F2e",
+]
+
+# growth features calculated from the yearly checkpoints
+# (feature name, source column, number of years)
+growth_features = [
+    ("advisor_growth_1y", "5B3", 1),
+    ("advisor_growth_3y", "5B3", 3),
+    ("asset_growth_1y", "5F2c", 1),
+    ("asset_growth_3y", "5F2c", 3),
+    ("assets_per_advisor_growth_1y", "assets_per_advisor", 1),
+    ("assets_per_advisor_growth_3y", "assets_per_advisor", 3),
+    ("clients_per_advisor_growth_1y", "clients_per_advisor", 1),
+    ("clients_per_advisor_growth_3y", "clients_per_advisor", 3),
+    ("assets_per_client_growth_1y", "assets_per_client", 1),
+    ("assets_per_client_growth_3y", "assets_per_client", 3),
+    ("disc_to_total_assets_growth_1y", "disc_to_total_assets", 1),
+    ("disc_to_total_assets_growth_3y", "disc_to_total_assets", 3),
+]
+
+
+def derive_features(df):
+    # the per-filing derivations (also applied to filings of advisors outside the
+    # models, see src.prospect_querying); no filings are dropped here
 
     # if DBA name is null (1B or 1B1), use legal name (1A)
     df["name"] = df["1B"]
@@ -34,87 +143,13 @@ def engineer_features():
     df = df.fillna(value=values)
 
     # setting null financial planning client values(5H) to 0 and discretizing rest
-    disc = {
-        "0": 0,
-        "1-10": 1,
-        "11-25": 11,
-        "26-50": 26,
-        "51-100": 51,
-        "101-250": 101,
-        "251-500": 251,
-        "More than 500": 501,
-    }
-    df["5H"] = df["5H"].map(disc)
+    df["5H"] = df["5H"].map(planning_clients)
     df["5H"] = df["5H"].fillna(value=0)
 
-    # remove records with missing ID
-    df = df.loc[df["1D"] != "801-", :]
-
-    # setting region based on state (based on Bureau of Economic Analysis regions)
-    region = {
-        "AL": "Southeast",
-        "AK": "FarWest",
-        "AR": "Southeast",
-        "AZ": "Southwest",
-        "CA": "FarWest",
-        "CO": "RockyMountain",
-        "CT": "NewEngland",
-        "DC": "Mideast",
-        "DE": "Mideast",
-        "FL": "Southeast",
-        "GA": "Southeast",
-        "GU": "Foreign",
-        "HI": "FarWest",
-        "IA": "Plains",
-        "ID": "RockyMountain",
-        "IL": "GreatLakes",
-        "IN": "GreatLakes",
-        "KS": "Plains",
-        "KY": "Southeast",
-        "LA": "Southeast",
-        "MA": "NewEngland",
-        "MD": "Mideast",
-        "ME": "NewEngland",
-        "MI": "GreatLakes",
-        "MN": "Plains",
-        "MO": "Plains",
-        "MS": "Southeast",
-        "MT": "RockyMountain",
-        "NC": "Southeast",
-        "ND": "Plains",
-        "NE": "Plains",
-        "NH": "NewEngland",
-        "NJ": "Mideast",
-        "NM": "Southwest",
-        "NV": "FarWest",
-        "NY": "Mideast",
-        "OH": "GreatLakes",
-        "OK": "Southwest",
-        "OR": "FarWest",
-        "PA": "Mideast",
-        "PR": "Foreign",
-        "RI": "NewEngland",
-        "SC": "Southeast",
-        "SD": "Plains",
-        "TN": "Southeast",
-        "TX": "Southwest",
-        "UT": "RockyMountain",
-        "VA": "Southeast",
-        "VI": "Foreign",
-        "VT": "NewEngland",
-        "WA": "FarWest",
-        "WI": "GreatLakes",
-        "WV": "Southeast",
-        "WY": "RockyMountain",
-    }
-    df["region"] = df["1F1-State"].map(region)
-    df["region"] = df["region"].fillna(value="Foreign")
-
-    # drop records with no employees or advisors
-    df = df.loc[(df["5A"] > 0) & (df["5B3"] > 0), :]
-
-    # drop records with no assets or clients
-    df = df.loc[(df["5F2c"] > 0) & (df["5F2f"] > 0), :]
+    # setting region based on state (the states are categorical, and so is their
+    # region when no two of them share one, e.g. for a single filing)
+    df["region"] = df["1F1-State"].map(regions).astype(object, copy=False)
+    df["region"] = df["region"].fillna(value="Foreign").astype("category")
 
     # create advisory-to-brokerage-employee ratio
     df["advisory_to_brokerage"] = df["5B3"] / df["5B2"]
@@ -131,25 +166,228 @@ def engineer_features():
     # create discretionary ratio
     df["disc_to_total_assets"] = df["5F2a"] / df["5F2c"]
 
-    # get latest submission; only keep advisors with recent filings
+    # filings are resampled by day
     df["DateSubmitted"] = df["DateSubmitted"].dt.floor("d")
-    latest = df.loc[:, ["1D", "DateSubmitted"]].groupby("1D").agg("max").reset_index()
-    max_date = latest["DateSubmitted"].max()
-    max_date = datetime(max_date.year, max_date.month, max_date.day)
+    return df
 
-    def recent_filing(x):
-        return x >= max_date - relativedelta(years=1)
 
-    latest = latest.loc[latest["DateSubmitted"].apply(recent_filing), :]
-    latest = latest["1D"].drop_duplicates().tolist()
-    df = df.loc[df["1D"].isin(latest), :]
+def drop_incomplete(df):
+    # drop records with no employees or advisors
+    df = df.loc[(df["5A"] > 0) & (df["5B3"] > 0), :]
+
+    # drop records with no assets or clients
+    df = df.loc[(df["5F2c"] > 0) & (df["5F2f"] > 0), :]
+    return df
+
+
+def in_retail_scope(df):
+    # retail investment advisors only (no institutional)
+    return (df["5G2"] == 1) & (df["5G3"] == 0) & (df["5G4"] == 0)
+
+
+def fill_single_checkpoint(ts, rows):
+    # advisors with a single checkpoint have no history to compare against, so
+    # their missing values are taken as 0. Only numeric columns are filled: a
+    # missing state stays missing (and is reported as Foreign, like any other
+    # advisor without one) rather than becoming 0, which the categorical state
+    # column couldn't hold anyway. The numeric columns are found from the dtypes
+    # since select_dtypes copies the frame
+    numeric = [col for col, dtype in ts.dtypes.items() if is_numeric_dtype(dtype)]
+    ts.loc[rows, numeric] = ts.loc[rows, numeric].fillna(0)
+    return ts
+
+
+def resample_advisor(df, advisor, checkpoints, max_date):
+    # original implementation, one advisor at a time; kept as a reference for
+    # resample_advisors
+    adv = df.loc[df["1D"] == advisor, :]
+    adv = adv.drop_duplicates(subset="DateSubmitted", keep="last")
+    adv = adv.set_index("DateSubmitted")
+    adv = adv.append(pd.Series(name=max_date + relativedelta(days=+1)))
+    adv = adv.resample("D").ffill()
+    adv = adv.loc[adv.index.isin(checkpoints), :]
+
+    # while we're at it, add more features using the time series
+    for feature, col, years in growth_features:
+        adv[feature] = adv[col].pct_change(years)
+
+    if len(adv) == 1:
+        adv = fill_single_checkpoint(adv, adv.index)
+    adv = adv.reset_index()
+    return adv
+
+
+def resample_advisors(df, checkpoints):
+    # last filing of each day for each advisor
+    df = df.drop_duplicates(subset=["1D", "DateSubmitted"], keep="last")
+
+    # every checkpoint on or after each advisor's first filing (advisors are kept
+    # in order of first appearance)
+    first = df.groupby("1D", sort=False, observed=True)["DateSubmitted"].min()
+    checkpoints = pd.DatetimeIndex(checkpoints).sort_values()
+    grid = pd.DataFrame(
+        {
+            "1D": first.index.repeat(len(checkpoints)),
+            "checkpoint": np.tile(checkpoints.values, len(first)),
+            "order": np.arange(len(first)).repeat(len(checkpoints)),
+        }
+    )
+    grid = grid.loc[grid["checkpoint"] >= grid["1D"].map(first), :]
+
+    # values as of each checkpoint are those of the latest filing on or before it
+    ts = pd.merge_asof(
+        grid.sort_values("checkpoint"),
+        df.sort_values("DateSubmitted"),
+        left_on="checkpoint",
+        right_on="DateSubmitted",
+        by="1D",
+    )
+    ts = ts.sort_values(["order", "checkpoint"]).reset_index(drop=True)
+    ts["DateSubmitted"] = ts["checkpoint"]
+    ts = ts.loc[:, ["DateSubmitted"] + df.columns.drop("DateSubmitted").tolist()]
+    ints = ts.select_dtypes("integer").columns
+    ts[ints] = ts[ints].astype("float64")
+
+    # while we're at it, add more features using the time series (matching
+    # pct_change, values are forward filled within each advisor first)
+    advisors = ts.groupby("1D", sort=False, observed=True)
+    for feature, col, years in growth_features:
+        filled = advisors[col].ffill()
+        ts[feature] = filled / filled.groupby(ts["1D"], observed=True).shift(years) - 1
+
+    single = advisors["1D"].transform("size") == 1
+    return fill_single_checkpoint(ts, single)
+
+
+def history_hashes(df):
+    # fingerprint of each advisor's filing history
+    rows = pd.util.hash_pandas_object(df, index=False)
+    return rows.groupby(np.asarray(df["1D"]), sort=False).agg(
+        lambda h: hashlib.sha1(h.values.tobytes()).hexdigest()
+    )
+
+
+def moved_advisors(df, old_checkpoints, checkpoints):
+    # advisors whose values change when the checkpoints move (e.g. when a new
+    # month of filings moves max_date), i.e. those with a filing between a
+    # checkpoint and where it moved to; None when the checkpoints can't be paired
+    # up (one was added or dropped, or they moved by half a year or more)
+    old = pd.DatetimeIndex(old_checkpoints).sort_values()
+    new = pd.DatetimeIndex(checkpoints).sort_values()
+    if len(old) != len(new) or abs(new - old).max() >= pd.Timedelta(days=183):
+        return None
+    lower = np.minimum(old.values, new.values)
+    upper = np.maximum(old.values, new.values)
+    dates = df["DateSubmitted"].values
+    i = np.searchsorted(lower, dates, side="left") - 1
+    moved = (i >= 0) & (dates <= upper[np.maximum(i, 0)])
+    return df.loc[moved, "1D"].unique()
+
+
+def update_resampled(ts, history, df, new_history, checkpoints, old_checkpoints):
+    # only advisors whose filing history changed, or whose values moved with the
+    # checkpoints, are resampled again; the rows of the others keep their values
+    # (and growth) and are moved to the new checkpoints
+    unchanged = new_history.index[new_history == history.reindex(new_history.index)]
+    moved = moved_advisors(df, old_checkpoints, checkpoints)
+    unchanged = unchanged[~unchanged.isin(moved)]
+    changed = df.loc[~df["1D"].isin(unchanged), :]
+    ts = ts.loc[ts["1D"].isin(unchanged), :]
+    moves = dict(zip(sorted(old_checkpoints), sorted(checkpoints)))
+    ts = ts.assign(DateSubmitted=ts["DateSubmitted"].map(moves))
+    if len(changed) > 0:
+        ts = pd.concat([ts, resample_advisors(changed, checkpoints)])
+
+    # restore the order of advisors in df
+    order = pd.Series(np.arange(len(new_history)), index=new_history.index)
+    ts = ts.iloc[np.argsort(ts["1D"].map(order).values, kind="stable"), :]
+    return ts.reset_index(drop=True)
+
+
+def save_if_changed(df, path, schema):
+    # frames are saved partitioned by region (and compared in their schema)
+    df = apply_schema(df, schema)
+    if os.path.exists(path) and read_frame(path, schema=schema).equals(df):
+        return False
+    write_frame(df, path, partition_cols=["region"], schema=schema)
+    return True
+
+
+def fill_features(X):
+    # fills NAs with 0 and infs with 1 (in place)
+    return np.nan_to_num(X, copy=False, nan=0, posinf=1, neginf=1)
+
+
+def fit_clip_limits(X, quantiles=(0.01, 0.99)):
+    # lower and upper limits of each feature (column of filled X), in one pass
+    return np.quantile(X, quantiles, axis=0).astype(X.dtype)
+
+
+def clip_features(X, limits):
+    return np.clip(X, limits[0], limits[1], out=X)
+
+
+def finalize_features(X, limits):
+    # fills and clips features in place, so new rows can be transformed with the
+    # limits of the pipeline
+    return clip_features(fill_features(X), limits)
+
+
+def save_clip_limits(path, features, limits, checkpoints):
+    # (with the checkpoints the features were resampled at, so new rows are
+    # engineered as of the same dates)
+    np.savez(
+        path,
+        features=np.asarray(features, dtype=str),
+        limits=limits,
+        checkpoints=np.asarray(checkpoints, dtype="datetime64[ns]"),
+    )
+
+
+def load_clip_limits(path):
+    saved = np.load(path)
+    checkpoints = None
+    if "checkpoints" in saved:
+        checkpoints = pd.DatetimeIndex(saved["checkpoints"]).tolist()
+    return saved["features"].tolist(), saved["limits"], checkpoints
+
+
+def engineer_features(engine="vectorized", incremental=False):
+    # read in processed data
+    with profiling.step("parquet read") as record:
+        # processed data is engineered in its compact dtypes (see src.schema)
+        df = read_frame(
+            f"{app_dir}/data/processed/selected_data", schema="selected_data"
+        )
+        record["rows_out"] = len(df)
+    with profiling.step("clean", rows_in=len(df)) as record:
+        df = derive_features(df)
+
+        # remove records with missing ID
+        df = df.loc[df["1D"] != "801-", :]
+        df = drop_incomplete(df)
+
+        # get latest submission; only keep advisors with recent filings
+        latest = df.loc[:, ["1D", "DateSubmitted"]].groupby("1D", observed=True).max()
+        latest = latest.reset_index()
+        max_date = latest["DateSubmitted"].max()
+        max_date = datetime(max_date.year, max_date.month, max_date.day)
+
+        def recent_filing(x):
+            return x >= max_date - relativedelta(years=1)
+
+        latest = latest.loc[latest["DateSubmitted"].apply(recent_filing), :]
+        latest = latest["1D"].drop_duplicates().tolist()
+        df = df.loc[df["1D"].isin(latest), :]
+
+        # narrowing scope to include only retail investment advisors (no institutional)
+        # can change this in the future to broaden or change scope
+        df = df.loc[in_retail_scope(df), :]
+        for col in df.columns:
+            if col.find("5G") > -1:
+                df = df.drop(col, axis=1)
+        record["rows_out"] = len(df)
 
-    # narrowing scope to include only retail investment advisors (no institutional)
-    # can change this in the future to broaden or change scope
-    df = df.loc[(df["5G2"] == 1) & (df["5G3"] == 0) & (df["5G4"] == 0), :]
-    for col in df.columns:
-        if col.find("5G") > -1:
-            df = df.drop(col, axis=1)
     # resample to get values at at yearly checkpoints in the past
     min_date = df["DateSubmitted"].min()
     min_date = datetime(min_date.year, min_date.month, min_date.day)
@@ -158,74 +396,78 @@ def engineer_features():
     for i in range(span + 1):
         checkpoints.append(max_date - relativedelta(years=+i))
 
-    def do_resample(advisor):
-        adv = df.loc[df["1D"] == advisor, :]
-        adv = adv.drop_duplicates(subset="DateSubmitted", keep="last")
-        adv = adv.set_index("DateSubmitted")
-        adv = adv.append(pd.Series(name=max_date + relativedelta(days=+1)))
-        adv = adv.resample("D").ffill()
-        adv = adv.loc[adv.index.isin(checkpoints), :]
-
-        # while we're at it, add more features using the time series
-        adv["advisor_growth_1y"] = adv["5B3"].pct_change()
-        adv["advisor_growth_3y"] = adv["5B3"].pct_change(3)
-        adv["asset_growth_1y"] = adv["5F2c"].pct_change()
-        adv["asset_growth_3y"] = adv["5F2c"].pct_change(3)
-        adv["assets_per_advisor_growth_1y"] = adv["assets_per_advisor"].pct_change()
-        adv["assets_per_advisor_growth_3y"] = adv["assets_per_advisor"].pct_change(3)
-        adv["clients_per_advisor_growth_1y"] = adv["clients_per_advisor"].pct_change()
-        adv["clients_per_advisor_growth_3y"] = adv["clients_per_advisor"].pct_change(3)
-        adv["assets_per_client_growth_1y"] = adv["assets_per_client"].pct_change()
-        adv["assets_per_client_growth_3y"] = adv["assets_per_client"].pct_change(3)
-        adv["disc_to_total_assets_growth_1y"] = adv["disc_to_total_assets"].pct_change()
-        adv["disc_to_total_assets_growth_3y"] =adv["disc_to_total_assets"].pct_change(3)
-
-        if len(adv) == 1:
-            adv = adv.fillna(0)
-        adv = adv.reset_index()
-        return adv
-
-    ts = pd.DataFrame()
-    advisors = df["1D"].drop_duplicates().tolist()
-    for advisor in tqdm(advisors, desc="resampling"):
-        ts = ts.append(do_resample(advisor), ignore_index=True)
+    # the resampled time series are cached so that an incremental run only has to
+    # resample advisors whose filings changed or whose values moved with the
+    # checkpoints (e.g. when a new month of filings moved max_date)
+    history = history_hashes(df)
+    cache = f"{app_dir}/data/engineered/resampled.h5"
+    cached = False
+    if incremental and os.path.exists(cache):
+        with pd.HDFStore(cache, "r") as store:
+            if "/checkpoints" in store.keys():
+                cached_checkpoints = store["checkpoints"].tolist()
+                moved = moved_advisors(df, cached_checkpoints, checkpoints)
+                cached = moved is not None
+
+    with profiling.step("resample", rows_in=len(df), engine=engine) as record:
+        if engine == "legacy":
+            ts = pd.DataFrame()
+            advisors = df["1D"].drop_duplicates().tolist()
+            for advisor in tqdm(advisors, desc="resampling"):
+                adv = resample_advisor(df, advisor, checkpoints, max_date)
+                ts = ts.append(adv, ignore_index=True)
+        elif cached:
+            cached_ts = pd.read_hdf(cache, "ts")
+            cached_history = pd.read_hdf(cache, "history")
+            ts = update_resampled(
+                cached_ts, cached_history, df, history, checkpoints, cached_checkpoints
+            )
+        else:
+            ts = resample_advisors(df, checkpoints)
+        record["rows_out"] = len(ts)
+        record["cached"] = bool(cached)
+    ts.to_hdf(cache, "ts", format="table")
+    history.to_hdf(cache, "history", format="table")
+    pd.Series(checkpoints).to_hdf(cache, "checkpoints", format="table")
+
     # keep the records as of max_date
     engineered = ts.loc[ts["DateSubmitted"] == max_date, :]
 
     # save pre-adjusted calculations for reporting
-    engineered.to_hdf(f"{app_dir}/data/reporting/reporting_data.h5", "df")
-
-    # drop columns not being used as features as they are either only for
-    # contextual information or derivatives of them have been calculated and used
-    # keep region since regional models will be built as well as the advisor ID
-    not_features = [
-        "DateSubmitted",
-        "1F1-State",
-        "name",
-        "5A",
-        "5B1",
-        "5B2",
-        "5B5",
-        "5F2a",
-        "5F2b",
-        "5F2d",
-        "5F2e",
-    ]
+    changed = save_if_changed(
+        engineered, f"{app_dir}/data/reporting/reporting_data", "reporting_data"
+    )
+
+    # drop columns not being used as features (keeping region since regional
+    # models will be built as well as the advisor ID)
     engineered = engineered.drop(not_features, axis=1)
 
-    # fill NAs with 0 and infs with 1
-    engineered = engineered.fillna(0)
-    engineered = engineered.replace([np.inf, -np.inf], 1)
+    with profiling.step("finalize", rows_in=len(engineered)) as record:
+        # clipping features (as one float32 matrix, once NAs and infs are filled) so
+        # extremely large or small values don't have an oversized effect on the
+        # similarity algorithm; the limits are saved to transform new rows with
+        features = engineered.columns.drop(["1D", "region"])
+        X = engineered[features].to_numpy(dtype=np.float32)
+        limits = fit_clip_limits(fill_features(X))
+        clip_features(X, limits)
+        save_clip_limits(
+            f"{app_dir}/data/engineered/clip_limits.npz",
+            features.tolist(),
+            limits,
+            checkpoints,
+        )
+        finalized = pd.DataFrame(X, columns=features)
+        finalized["1D"] = engineered["1D"].to_numpy()
+        finalized["region"] = engineered["region"].to_numpy()
+        engineered = finalized.loc[:, engineered.columns]
+        record["rows_out"] = len(engineered)
 
-    # clipping features so extremely large or small values don't have an
-    # oversized effect on the similarity algorithm
-    for col in engineered.columns:
-        if col not in ["region", "1D"]:
-            limits = np.quantile(engineered[col].values, [0.01, 0.99])
-            engineered[col] = np.clip(engineered[col].values, limits[0], limits[1])
     # save to file
-    engineered = engineered.reset_index(drop=True)
-    engineered.to_hdf(f"{app_dir}/data/engineered/unscaled_features.h5", "df")
+    if save_if_changed(
+        engineered, f"{app_dir}/data/engineered/unscaled_features", "unscaled_features"
+    ):
+        changed = True
+    return changed
 
 
 if __name__ == "__main__":
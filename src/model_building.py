@@ -1,63 +1,170 @@
 # -*- coding: utf-8 -*-
 
-import pandas as pd
+import numpy as np
 from sklearn.preprocessing import StandardScaler
 from sklearn.decomposition import PCA
 from sklearn.neighbors import NearestNeighbors
 from joblib import dump
+from src.neighbor_indexing import build_index, recall_at_k
+from src.serving import save_build, save_bundle
+from src.settings import app_dir
+from src import profiling
+from src.storage import read_frame
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from glob import glob
 import os
 
 
-app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# recall of an approximate index below which the loss of neighbors is pointed out
+min_recall = 0.95
 
 
-def pipeline(df, region):
+def pipeline(df, region, backend="exact", save_features=True, index_params=None):
+    # returns what is worth reporting about the region's models (the recall of an
+    # approximate index)
 
     # narrow by region
     if region == "full":
         region_df = df.copy()
     else:
         region_df = df.loc[df["region"] == region, :]
-    # create feature set (save to disk)
+    # create feature set (save to disk as float32 so it can be memory-mapped,
+    # unless it would only be a copy of the unscaled features)
     not_features = ["1D", "region"]
-    X = region_df.drop(not_features, axis=1).values
-    dump(X, f"{app_dir}/data/engineered/X_{region}.pkl")
+    X = region_df.drop(not_features, axis=1).values.astype(np.float32)
+    if save_features:
+        np.save(f"{app_dir}/data/engineered/X_{region}.npy", X)
 
-    # save IDs for later
-    ids = region_df["1D"].values
-    dump(ids, f"{app_dir}/data/engineered/ID_{region}.pkl")
+    # save IDs for later (fixed-width strings, also for memory-mapping)
+    ids = region_df["1D"].values.astype(str)
+    np.save(f"{app_dir}/data/engineered/ID_{region}.npy", ids)
 
-    # scale features (save scaler to disk)
-    scaler = StandardScaler()
-    scaler.fit(X)
-    X_scaled = scaler.transform(X)
-    dump(scaler, f"{app_dir}/models/scaler_{region}.pkl")
+    # save regions of the full model so it can be queried within a region
+    if region == "full":
+        regions = region_df["region"].values.astype(str)
+        np.save(f"{app_dir}/data/engineered/region_full.npy", regions)
+
+    # scale features
+    with profiling.step("scaler fit", rows_in=len(X)):
+        scaler = StandardScaler()
+        X_scaled = scaler.fit_transform(X.astype(np.float64))
 
     # reduce dimensionality to where number of components explains at least
-    # 95% of the variance (save reducer to disk)
-    reducer = PCA(0.95)
-    reducer.fit(X_scaled)
-    X_reduced = reducer.transform(X_scaled)
-    dump(reducer, f"{app_dir}/models/reducer_{region}.pkl")
+    # 95% of the variance (save reduced features to disk)
+    with profiling.step("pca fit", rows_in=len(X_scaled)) as record:
+        reducer = PCA(0.95)
+        reducer.fit(X_scaled)
+        X_reduced = reducer.transform(X_scaled).astype(np.float32)
+        record["components"] = int(reducer.n_components_)
+    np.save(f"{app_dir}/data/engineered/Z_{region}.npy", X_reduced)
+
+    # export the scaler and reducer parameters for the NumPy-only serving bundle
+    save_bundle(region, scaler, reducer, X_reduced)
 
     # create nearest neighbors model (save model to disk)
-    model = NearestNeighbors()
-    model.fit(X_reduced)
+    with profiling.step("nn fit", rows_in=len(X_reduced)):
+        model = NearestNeighbors()
+        model.fit(X_reduced)
     dump(model, f"{app_dir}/models/model_{region}.pkl")
 
+    # create an approximate index alongside it, recording its recall against the
+    # exact model for the 20 neighbors (plus the advisor) shown in the dashboard
+    if backend != "exact":
+        with profiling.step(f"{backend} fit", rows_in=len(X_reduced)):
+            index = build_index(backend, **(index_params or dict()))
+            index.fit(X_reduced)
+        index.recall_ = recall_at_k(index, model, X_reduced, k=21)
+        dump(index, f"{app_dir}/models/model_{region}_{backend}.pkl")
+        return {"recall": round(float(index.recall_), 4)}
+    return dict()
+
+
+def report_recall(region, backend, info):
+    if "recall" in info:
+        message = f"{region}: {backend} recall@21 of {info['recall']:.3f}"
+        if info["recall"] < min_recall:
+            message += f", below {min_recall} (try a larger n_probe)"
+        tqdm.write(message)
+
+
+def read_unscaled_features():
+    return read_frame(
+        f"{app_dir}/data/engineered/unscaled_features", schema="unscaled_features"
+    )
+
+
+# the unscaled features in a worker process, read once by each worker rather than
+# pickled along with every region
+worker_df = None
+
+
+def init_worker():
+    global worker_df
+    worker_df = read_unscaled_features()
+
+
+def worker_pipeline(region, backend="exact", save_features=True, index_params=None):
+    return pipeline(worker_df, region, backend, save_features, index_params)
+
+
+def remove_stale_models(regions, backend):
+    # artifacts of regions (or of an approximate backend) that weren't built, e.g.
+    # the regional models left by a build before a global one
+    paths = glob(f"{app_dir}/models/model_*.pkl")
+    paths += glob(f"{app_dir}/models/serving_*.npz")
+    for prefix in ["X", "ID", "Z"]:
+        paths += glob(f"{app_dir}/data/engineered/{prefix}_*.npy")
+    for path in paths:
+        region, *index = os.path.splitext(os.path.basename(path))[0].split("_")[1:]
+        if region not in regions or index not in ([], [backend]):
+            os.remove(path)
+
+
+def build_regional_models(
+    workers=1, backend="exact", mode="regional", index_params=None
+):
+    # (index_params are passed to the approximate index, e.g. n_lists, n_probe)
 
-def build_regional_models():
     # read in unscaled features
-    df = pd.read_hdf(f"{app_dir}/data/engineered/unscaled_features.h5")
+    df = read_unscaled_features()
 
-    # get regions
+    # get regions ("full" first since it is the longest task); in global mode only
+    # the full model is built (without a copy of the unscaled features) and
+    # regions are answered by filtering it
     regions = df["region"].drop_duplicates().tolist()
-    regions.append("full")
-
-    # pull each region through the pipeline to build regional models
-    for region in tqdm(regions):
-        pipeline(df, region)
+    regions.insert(0, "full")
+    save_features = mode != "global"
+    if mode == "global":
+        regions = ["full"]
+        if os.path.exists(f"{app_dir}/data/engineered/X_full.npy"):
+            os.remove(f"{app_dir}/data/engineered/X_full.npy")
+
+    # pull each region through the pipeline to build regional models (the steps
+    # inside worker processes aren't recorded, so with workers each region's step
+    # is the wait for it)
+    if workers > 1:
+        with ProcessPoolExecutor(workers, initializer=init_worker) as executor:
+            results = executor.map(
+                worker_pipeline,
+                regions,
+                repeat(backend),
+                repeat(save_features),
+                repeat(index_params),
+            )
+            for region in tqdm(regions):
+                with profiling.step(region) as record:
+                    record.update(next(results))
+                report_recall(region, backend, record)
+    else:
+        for region in tqdm(regions):
+            with profiling.step(region) as record:
+                info = pipeline(df, region, backend, save_features, index_params)
+                record.update(info)
+            report_recall(region, backend, record)
+    remove_stale_models(regions, backend)
+    save_build(mode, backend, regions)
 
 
 if __name__ == "__main__":
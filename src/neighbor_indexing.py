@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+from src.serving import squared_distances
+
+
+def nearest(X, Y, chunk_size=10000):
+    # index of the nearest row of Y for each row of X
+    nearest = np.empty(len(X), dtype=np.intp)
+    for start in range(0, len(X), chunk_size):
+        stop = start + chunk_size
+        nearest[start:stop] = squared_distances(X[start:stop], Y).argmin(axis=1)
+    return nearest
+
+
+class IVFIndex:
+    # approximate nearest neighbors with an inverted file index: points are
+    # grouped into lists by their nearest k-means centroid and a query only
+    # searches the lists of its n_probe nearest centroids
+    def __init__(self, n_lists=None, n_probe=8, n_iter=10, random_state=0):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.random_state = random_state
+
+    def fit(self, X):
+        X = np.asarray(X, dtype=float)
+        n_lists = self.n_lists or max(1, int(np.sqrt(len(X))))
+        n_lists = min(n_lists, len(X))
+
+        # coarse quantizer (k-means, keeping the old centroid of empty lists)
+        rng = np.random.default_rng(self.random_state)
+        centroids = X[rng.choice(len(X), n_lists, replace=False)]
+        for _ in range(self.n_iter):
+            assigned = nearest(X, centroids)
+            counts = np.bincount(assigned, minlength=n_lists)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assigned, X)
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+        assigned = nearest(X, centroids)
+
+        # inverted lists: points sorted by list, with each list's offsets
+        self.order_ = np.argsort(assigned, kind="stable")
+        self.offsets_ = np.searchsorted(assigned[self.order_], np.arange(n_lists + 1))
+        self.centroids_ = centroids
+        self.X_ = X
+        return self
+
+    def kneighbors(self, X, n_neighbors=5, return_distance=True):
+        X = np.asarray(X, dtype=float)
+        sizes = np.diff(self.offsets_)
+        distances = np.empty((len(X), n_neighbors))
+        neighbors = np.empty((len(X), n_neighbors), dtype=np.intp)
+        probes = np.argsort(squared_distances(X, self.centroids_), axis=1)
+        for i, x in enumerate(X):
+            # probe at least n_probe lists, and enough to have n_neighbors points
+            enough = np.searchsorted(np.cumsum(sizes[probes[i]]), n_neighbors)
+            probe = probes[i, : max(self.n_probe, enough + 1)]
+            candidates = np.concatenate(
+                [self.order_[self.offsets_[j] : self.offsets_[j + 1]] for j in probe]
+            )
+
+            # exact search over the candidates (ties broken by row)
+            d = ((self.X_[candidates] - x) ** 2).sum(axis=1)
+            top = np.argpartition(d, n_neighbors - 1)[:n_neighbors]
+            top = top[np.lexsort((candidates[top], d[top]))]
+            distances[i] = np.sqrt(d[top])
+            neighbors[i] = candidates[top]
+
+        if return_distance:
+            return distances, neighbors
+        return neighbors
+
+
+def exact_index(**params):
+    # (sklearn is only imported to build the models, not to query them)
+    from sklearn.neighbors import NearestNeighbors
+
+    return NearestNeighbors(**params)
+
+
+# nearest neighbor backends that can be used by the models
+backends = {"exact": exact_index, "ivf": IVFIndex}
+
+
+def build_index(backend="exact", **params):
+    if backend not in backends:
+        raise ValueError(f"unknown backend: {backend} (choose from {list(backends)})")
+    return backends[backend](**params)
+
+
+def recall_at_k(index, exact, X, k=20, n_queries=1000, random_state=0):
+    # share of the exact k nearest neighbors found by the index for a sample of X
+    rng = np.random.default_rng(random_state)
+    rows = rng.choice(len(X), min(n_queries, len(X)), replace=False)
+    k = min(k, len(X))
+    found = index.kneighbors(X[rows], k, return_distance=False)
+    truth = exact.kneighbors(X[rows], k, return_distance=False)
+    hits = [len(np.intersect1d(f, t)) for f, t in zip(found, truth)]
+    return np.sum(hits) / (len(rows) * k)
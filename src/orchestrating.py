@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+from glob import glob
+import hashlib
+import inspect
+import json
+import os
+import sys
+from src import profiling
+from src.settings import app_dir
+
+
+cache_file = f"{app_dir}/data/stage_cache.json"
+report_file = f"{app_dir}/data/run_report.json"
+profile_dir = f"{app_dir}/data/profiles"
+
+
+class Stage:
+    # inputs and outputs are glob patterns relative to the app directory, and
+    # requires names the stages producing the inputs; params change the stage's
+    # outputs (and are part of its cache key) while options only change how it
+    # runs (e.g. number of workers)
+    def __init__(
+        self,
+        name,
+        func,
+        inputs=(),
+        outputs=(),
+        requires=(),
+        params=None,
+        options=None,
+        cache=True,
+    ):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.requires = list(requires)
+        self.params = params or dict()
+        self.options = options or dict()
+        self.cache = cache
+
+    def run(self):
+        return self.func(**self.params, **self.options)
+
+
+def expand(patterns):
+    paths = set()
+    for pattern in patterns:
+        paths.update(glob(f"{app_dir}/{pattern}", recursive=True))
+    return sorted(p for p in paths if os.path.isfile(p))
+
+
+def hash_files(paths):
+    hashes = dict()
+    for path in paths:
+        sha = hashlib.sha256()
+        with open(path, "rb") as fh:
+            for block in iter(lambda: fh.read(1 << 20), b""):
+                sha.update(block)
+        hashes[os.path.relpath(path, app_dir)] = sha.hexdigest()
+    return hashes
+
+
+def source_modules(func):
+    # the module of func and every module of its package it imports, directly or
+    # through other modules of the package (found from what their names refer to)
+    package = func.__module__.split(".")[0]
+    modules = dict()
+    pending = [sys.modules[func.__module__]]
+    while len(pending) > 0:
+        module = pending.pop()
+        if module.__name__ in modules:
+            continue
+        modules[module.__name__] = module
+        for value in vars(module).values():
+            if inspect.ismodule(value):
+                name = value.__name__
+            else:
+                name = getattr(value, "__module__", None)
+            if isinstance(name, str) and name.split(".")[0] == package:
+                pending.append(sys.modules[name])
+    return [modules[name] for name in sorted(modules)]
+
+
+def stage_key(stage):
+    # a stage is keyed by its inputs, its params and the source of its module and
+    # of the modules that one imports
+    sha = hashlib.sha256()
+    sha.update(stage.name.encode())
+    sha.update(json.dumps(stage.params, sort_keys=True, default=str).encode())
+    for module in source_modules(stage.func):
+        with open(inspect.getsourcefile(module), "rb") as fh:
+            sha.update(module.__name__.encode())
+            sha.update(fh.read())
+    sha.update(json.dumps(hash_files(expand(stage.inputs)), sort_keys=True).encode())
+    return sha.hexdigest()
+
+
+def dependencies(stages):
+    # the stages each stage requires (as declared, rather than by its inputs)
+    names = [s.name for s in stages]
+    for stage in stages:
+        for name in stage.requires:
+            if name not in names:
+                raise ValueError(f"{stage.name} requires an unknown stage: {name}")
+    return {stage.name: list(stage.requires) for stage in stages}
+
+
+def sort_stages(stages):
+    deps = dependencies(stages)
+    ordered = list()
+    while len(ordered) < len(stages):
+        done = [s.name for s in ordered]
+        ready = [
+            s
+            for s in stages
+            if s.name not in done and all(d in done for d in deps[s.name])
+        ]
+        if len(ready) == 0:
+            raise ValueError("stages have a circular dependency")
+        ordered.extend(ready)
+    return ordered
+
+
+def select_stages(stages, start=None, only=None):
+    names = [s.name for s in stages]
+    for name in ([start] if start else []) + (only or []):
+        if name not in names:
+            raise ValueError(f"unknown stage: {name} (choose from {names})")
+    if only:
+        return [s for s in stages if s.name in only]
+    if start is None:
+        return stages
+
+    # the start stage and every stage downstream of it
+    deps = dependencies(stages)
+    selected = {start}
+    for stage in stages:
+        if len(set(deps[stage.name]) & selected) > 0:
+            selected.add(stage.name)
+    return [s for s in stages if s.name in selected]
+
+
+def load_cache():
+    if os.path.exists(cache_file):
+        with open(cache_file) as fh:
+            return json.load(fh)
+    return dict()
+
+
+def save_cache(cache):
+    with open(cache_file, "w") as fh:
+        json.dump(cache, fh, indent=2)
+
+
+def run_stages(stages, start=None, only=None, force=False, profiler=None):
+    # a report of each stage (and its sub-steps) is written to report_file, and
+    # with a profiler ("cprofile" or "pyinstrument") a profile of each stage that
+    # runs is dumped to profile_dir
+    stages = select_stages(sort_stages(stages), start, only)
+    cache = load_cache()
+    statuses = dict()
+    try:
+        for stage in stages:
+            # skip the stage if its key matches and its outputs are as it left them
+            key = stage_key(stage) if stage.cache else None
+            cached = cache.get(stage.name, dict())
+            if (
+                not force
+                and key is not None
+                and cached.get("key") == key
+                and len(cached.get("outputs", dict())) > 0
+                and hash_files(expand(stage.outputs)) == cached["outputs"]
+            ):
+                print(f"{stage.name}: up to date")
+                statuses[stage.name] = "up to date"
+                continue
+
+            print(f"{stage.name}: running")
+            with profiling.step(stage.name):
+                if profiler is None:
+                    stage.run()
+                else:
+                    os.makedirs(profile_dir, exist_ok=True)
+                    extension = "html" if profiler == "pyinstrument" else "prof"
+                    path = f"{profile_dir}/{stage.name}.{extension}"
+                    profiling.run_profiled(stage.run, path, profiler)
+            statuses[stage.name] = "ran"
+            outputs = hash_files(expand(stage.outputs))
+            cache[stage.name] = {"key": key, "outputs": outputs}
+            save_cache(cache)
+    finally:
+        # also written when a stage fails, with the steps up to the failure
+        profiling.write_report(report_file, stages=statuses)
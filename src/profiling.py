@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager
+from datetime import datetime
+import cProfile
+import json
+import platform
+import resource
+import sys
+import time
+
+
+# finished steps (in the order they finished) and the stack of running ones;
+# sub-steps run in worker processes aren't recorded, though their CPU time is
+# included in the enclosing step's
+records = list()
+active = list()
+
+
+def peak_rss():
+    # peak resident memory (bytes) since the last reset, where Linux allows
+    # resetting it, and of the whole process otherwise
+    try:
+        with open("/proc/self/status") as fh:
+            for line in fh:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as fh:
+            fh.write("5")
+    except OSError:
+        pass
+
+
+def cpu_time():
+    # user and system time of the process and its finished children
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def start(name, **info):
+    # the peak so far belongs to the running step, before it is reset for this one
+    if len(active) > 0:
+        active[-1]["peak"] = max(active[-1]["peak"], peak_rss())
+        name = f"{active[-1]['record']['name']}/{name}"
+    reset_peak_rss()
+    record = {"name": name, **info}
+    active.append(
+        {"record": record, "wall": time.perf_counter(), "cpu": cpu_time(), "peak": 0}
+    )
+    return record
+
+
+def stop(record, **info):
+    # finishes a step (and any sub-steps left running inside it)
+    while len(active) > 0:
+        step = active.pop()
+        peak = max(step["peak"], peak_rss())
+        step["record"].update(
+            wall_s=round(time.perf_counter() - step["wall"], 4),
+            cpu_s=round(cpu_time() - step["cpu"], 4),
+            peak_rss_mb=round(peak / 2**20, 1),
+        )
+        records.append(step["record"])
+        if len(active) > 0:
+            active[-1]["peak"] = max(active[-1]["peak"], peak)
+        if step["record"] is record:
+            break
+    record.update(info)
+    return record
+
+
+@contextmanager
+def step(name, **info):
+    # record = the step's record, e.g. to set record["rows_out"] inside the block
+    record = start(name, **info)
+    try:
+        yield record
+    finally:
+        stop(record)
+
+
+def run_profiled(func, path, profiler="cprofile"):
+    # runs func under a profiler, dumping its results to path
+    if profiler == "pyinstrument":
+        from pyinstrument import Profiler
+
+        profile = Profiler()
+        profile.start()
+        try:
+            return func()
+        finally:
+            profile.stop()
+            with open(path, "w") as fh:
+                fh.write(profile.output_html())
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func)
+    finally:
+        profile.dump_stats(path)
+
+
+def write_report(path, **info):
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        **info,
+        "steps": records,
+    }
+    with open(path, "w") as fh:
+        json.dump(report, fh, indent=2, default=str)
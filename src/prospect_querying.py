@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+from src.data_processing import matches, select_col_names
+from src.feature_engineering import (
+    derive_features,
+    drop_incomplete,
+    finalize_features,
+    in_retail_scope,
+    load_clip_limits,
+    resample_advisors,
+)
+from src.schema import apply_schema
+from src.reporting import filtered_kneighbors, load_region, region_rows
+from src.serving import kneighbors, project
+from src.settings import app_dir
+
+
+clip_limits_file = f"{app_dir}/data/engineered/clip_limits.npz"
+
+# base fields of a filing the features are derived from (any that are missing
+# are taken as blank, just as in the Base A files)
+base_cols = [
+    "DateSubmitted",
+    "1A",
+    "1B",
+    "1B1",
+    "1D",
+    "1F1-State",
+    "5A",
+    "5A-Number",
+    "5B1",
+    "5B1-Number",
+    "5B2",
+    "5B2-Number",
+    "5B3",
+    "5B3-Number",
+    "5B4",
+    "5B5",
+    "5B6",
+    "5F2a",
+    "5F2b",
+    "5F2c",
+    "5F2d",
+    "5F2e",
+    "5F2f",
+    "5G2",
+    "5G3",
+    "5G4",
+    "5H",
+]
+
+# clip limits by path, with the modification time of the file they were loaded
+# from (so they are reloaded once the pipeline runs again)
+file_cache = dict()
+
+
+def load_cached(path, load):
+    mtime = os.path.getmtime(path)
+    if path not in file_cache or file_cache[path][0] != mtime:
+        file_cache[path] = (mtime, load())
+    return file_cache[path][1]
+
+
+def to_filings(rows):
+    # raw Form ADV rows (a frame or list of dicts, or a single dict) as processed
+    # data: the kept columns in their compact dtypes; filings without an SEC
+    # number are told apart by their row
+    if isinstance(rows, dict):
+        rows = [rows]
+    df = pd.DataFrame(rows).reset_index(drop=True)
+    df = df.loc[:, select_col_names(df.columns, matches)]
+    df = df.reindex(columns=df.columns.union(base_cols, sort=False))
+
+    missing = df["1D"].isnull() | (df["1D"] == "801-")
+    df.loc[missing, "1D"] = [f"row {i}" for i in df.index[missing]]
+    df["DateSubmitted"] = pd.to_datetime(df["DateSubmitted"])
+    df["DateSubmitted"] = df["DateSubmitted"].fillna(pd.Timestamp.now())
+    return apply_schema(df, "selected_data")
+
+
+def prospect_features(rows, features, limits, checkpoints):
+    # the finalized features of each prospect as the pipeline engineered them: as
+    # of its latest checkpoint, with growth at the checkpoints before it (the
+    # checkpoints of the pipeline, latest first)
+    df = derive_features(to_filings(rows))
+    max_date = checkpoints[0]
+
+    # filings are left out as in the pipeline (advisors need a complete filing in
+    # the year to max_date), except that filings which leave the 5G questions
+    # blank (e.g. dicts of the base fields) aren't scoped
+    kept = drop_incomplete(df)
+    latest = kept.groupby("1D", observed=True)["DateSubmitted"].transform("max")
+    kept = kept.loc[latest >= max_date - relativedelta(years=1), :]
+    answered = kept.loc[:, ["5G2", "5G3", "5G4"]].notnull().any(axis=1)
+    kept = kept.loc[in_retail_scope(kept) | ~answered, :]
+    left_out = df.loc[~df["1D"].isin(kept["1D"]), "1D"].unique().tolist()
+    if len(left_out) > 0:
+        raise ValueError(
+            f"{left_out} have no complete filing in the retail scope in the year "
+            f"to {max_date:%Y-%m-%d}"
+        )
+    df = kept
+
+    # filings since the pipeline's last day (e.g. of advisors that registered
+    # since) are taken as of max_date, the latest of each advisor only
+    later = df["DateSubmitted"] >= max_date + relativedelta(days=1)
+    newest = df.loc[later, :].groupby("1D", observed=True)["DateSubmitted"].idxmax()
+    df = df.loc[~later | df.index.isin(newest), :]
+    df = df.assign(DateSubmitted=df["DateSubmitted"].mask(later, max_date))
+
+    ts = resample_advisors(df, checkpoints)
+    ts = ts.loc[ts["DateSubmitted"] == max_date, :].reset_index(drop=True)
+    X = ts[features].to_numpy(dtype=np.float32)
+    return ts.loc[:, ["1D", "region"]], finalize_features(X, limits)
+
+
+def query_prospects(rows, region="full", k=20, mode="regional"):
+    # the k most similar advisors of a region to advisors that aren't in the
+    # models (e.g. ones that registered since they were built), from their raw
+    # filings; the features are scaled and reduced with the region's serving
+    # bundle, so no models are loaded or rebuilt. In global mode the full model
+    # is searched for neighbors in the region (as by query_neighbors)
+    features, limits, checkpoints = load_cached(
+        clip_limits_file, lambda: load_clip_limits(clip_limits_file)
+    )
+    if checkpoints is None:
+        raise ValueError(
+            "prospects are engineered at the checkpoints of the pipeline, which "
+            f"{clip_limits_file} doesn't have; run the engineer stage again"
+        )
+    model_region = "full" if mode == "global" else region
+    bundle = load_region(model_region)
+    prospects, X = prospect_features(rows, features, limits, checkpoints)
+
+    # one extra neighbor in case a prospect is in the model after all
+    Z = project(bundle.serving, X)
+    if model_region != region:
+        candidates = region_rows(bundle, region)
+        distances, neighbors = filtered_kneighbors(
+            Z, candidates, k + 1, bundle.X_reduced[candidates]
+        )
+    else:
+        distances, neighbors = kneighbors(bundle.serving, Z, k + 1)
+    n = distances.shape[1]
+    neighbors_df = pd.DataFrame()
+    neighbors_df["ID"] = np.repeat(prospects["1D"].astype(str).to_numpy(), n)
+    neighbors_df["region"] = np.repeat(prospects["region"].astype(str).to_numpy(), n)
+    neighbors_df["neighbor_ID"] = bundle.ids[neighbors.ravel()]
+    neighbors_df["distance"] = distances.ravel()
+
+    neighbors_df = neighbors_df.loc[
+        neighbors_df["neighbor_ID"] != neighbors_df["ID"], :
+    ]
+    neighbors_df = neighbors_df.groupby("ID", sort=False).head(k)
+    neighbors_df.insert(
+        2, "neighbor", neighbors_df.groupby("ID", sort=False).cumcount() + 1
+    )
+    return neighbors_df.reset_index(drop=True)
+
+
+def read_rows(path):
+    # filings from a CSV file (e.g. rows of a Base A file) or from a JSON file of
+    # one or more objects of the base fields
+    if os.path.splitext(path)[1].lower() == ".json":
+        with open(path) as fh:
+            return json.load(fh)
+    return pd.read_csv(path, encoding="ISO-8859-1", dtype=str)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Similar advisors for advisors that aren't in the models"
+    )
+    parser.add_argument("filings", help="CSV (Base A rows) or JSON file of filings")
+    parser.add_argument("--region", default="full")
+    parser.add_argument("-k", type=int, default=20, help="neighbors per advisor")
+    parser.add_argument("--mode", default="regional", choices=["regional", "global"])
+    parser.add_argument("--output", help="write the neighbors to a CSV file")
+    args = parser.parse_args()
+
+    neighbors = query_prospects(read_rows(args.filings), args.region, args.k, args.mode)
+    if args.output:
+        neighbors.to_csv(args.output, index=False)
+    else:
+        print(neighbors.to_string(index=False))
@@ -3,7 +3,15 @@
 import pandas as pd
 import numpy as np
 from joblib import load
+from src.serving import kneighbors, load_build, load_bundle, squared_distances
+from src.settings import app_dir
+from src import profiling
+from src.storage import read_frame
 from tqdm import tqdm
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from itertools import repeat
 import os
 import sqlite3 as db
 import warnings
@@ -11,38 +19,208 @@ import warnings
 warnings.filterwarnings("ignore")
 
 
-app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# artifacts of a region (memory-mapped where possible) along with an ID -> row
+# index; the full model also has the rows of each region, i.e. posting lists.
+# Exact queries are answered by the serving bundle, so the model is only loaded
+# for an approximate backend
+RegionBundle = namedtuple(
+    "RegionBundle",
+    ["X", "ids", "index", "serving", "model", "X_reduced", "postings"],
+)
 
+# least recently used region bundles, keyed by region
+region_cache = OrderedDict()
+region_cache_size = int(os.environ.get("RIA_REGION_CACHE_SIZE", 10))
 
-def get_neighbors(advisor_ID, region, k):
-    X = load(f"{app_dir}/data/engineered/X_{region}.pkl")
-    ids = load(f"{app_dir}/data/engineered/ID_{region}.pkl")
-    id_list = ids.tolist()
-    scaler = load(f"{app_dir}/models/scaler_{region}.pkl")
-    reducer = load(f"{app_dir}/models/reducer_{region}.pkl")
-    model = load(f"{app_dir}/models/model_{region}.pkl")
 
-    i = id_list.index(advisor_ID)
-    X_advisor = X[i].reshape(1, -1)
-    X_advisor = scaler.transform(X_advisor)
-    X_advisor = reducer.transform(X_advisor)
-    neighbors = model.kneighbors(X_advisor, k, return_distance=False)
-    neighbors = ids[neighbors]
+def set_region_cache_size(size):
+    global region_cache_size
+    region_cache_size = size
+    while len(region_cache) > region_cache_size:
+        region_cache.popitem(last=False)
+
+
+def model_path(region, backend="exact"):
+    if backend == "exact":
+        return f"{app_dir}/models/model_{region}.pkl"
+    return f"{app_dir}/models/model_{region}_{backend}.pkl"
+
+
+def load_region(region, backend="exact"):
+    # bundles are reloaded when the models on disk have been rebuilt (the serving
+    # bundle is rewritten along with them); an exact bundle is memory-mapped
+    # apart from its ID index, so it loads quickly and shares its pages across
+    # processes
+    build = load_build()
+    if build is not None and region not in build["regions"]:
+        message = f"there is no {region} model"
+        if build["mode"] == "global":
+            message += " in a global build; query the region in global mode"
+        raise ValueError(message)
+    if build is not None and backend not in ("exact", build["backend"]):
+        raise ValueError(f"the models were built without the {backend} backend")
+
+    key = (region, backend)
+    if backend == "exact":
+        mtime = os.path.getmtime(f"{app_dir}/models/serving_{region}.npz")
+    else:
+        mtime = os.path.getmtime(model_path(region, backend))
+    if key in region_cache and region_cache[key][0] == mtime:
+        region_cache.move_to_end(key)
+        return region_cache[key][1]
+
+    # (the unscaled features aren't saved for the full model in global mode)
+    engineered = f"{app_dir}/data/engineered"
+    X = None
+    if os.path.exists(f"{engineered}/X_{region}.npy"):
+        X = np.load(f"{engineered}/X_{region}.npy", mmap_mode="r")
+    serving = load_bundle(region)
+    model = None
+    if backend != "exact":
+        model = load(model_path(region, backend))
+
+    # index the first row of each ID
+    index = dict()
+    for i, id_ in enumerate(serving.ids):
+        index.setdefault(id_, i)
+
+    postings = None
+    if os.path.exists(f"{engineered}/region_{region}.npy"):
+        labels = np.load(f"{engineered}/region_{region}.npy")
+        postings = {r: np.flatnonzero(labels == r) for r in np.unique(labels)}
+    bundle = RegionBundle(
+        X, serving.ids, index, serving, model, serving.points, postings
+    )
+
+    region_cache[key] = (mtime, bundle)
+    set_region_cache_size(region_cache_size)
+    return bundle
+
+
+def filtered_kneighbors(X, candidates, k, X_candidates, chunk_size=10000):
+    # exact k nearest neighbors among the candidate rows (ties broken by row)
+    if k > len(candidates):
+        raise ValueError(f"k={k} is more than the {len(candidates)} candidates")
+    X = np.asarray(X, dtype=float)
+    X_candidates = np.asarray(X_candidates, dtype=float)
+    distances = np.empty((len(X), k))
+    neighbors = np.empty((len(X), k), dtype=np.intp)
+    for start in range(0, len(X), chunk_size):
+        stop = start + chunk_size
+        d = squared_distances(X[start:stop], X_candidates)
+        top = np.argpartition(d, k - 1, axis=1)[:, :k]
+        d = np.take_along_axis(d, top, axis=1)
+        order = np.lexsort((top, d), axis=1)
+        distances[start:stop] = np.sqrt(np.take_along_axis(d, order, axis=1))
+        neighbors[start:stop] = candidates[np.take_along_axis(top, order, axis=1)]
+    return distances, neighbors
+
+
+def region_rows(bundle, region):
+    # rows of the full model in a region (its posting list), for global mode
+    if bundle.postings is None:
+        raise ValueError(
+            "global mode needs the region of each row of the full model "
+            "(data/engineered/region_full.npy); run the models stage again"
+        )
+    return bundle.postings.get(region, np.array([], dtype=np.intp))
+
+
+def overfetch_kneighbors(model, X, candidates, k, X_all, overfetch=2):
+    # k nearest neighbors among the candidate rows from an approximate index of
+    # all rows: enough neighbors are fetched to expect overfetch times k of them
+    # among the candidates, and rows that still come up short are searched
+    # exactly
+    n = len(X_all)
+    fetch = min(n, int(np.ceil(overfetch * k * n / max(len(candidates), 1))))
+    fetched_distances, fetched = model.kneighbors(X, fetch)
+    in_region = np.isin(fetched, candidates)
+    found = in_region.sum(axis=1) >= k
+
+    distances = np.empty((len(X), k))
+    neighbors = np.empty((len(X), k), dtype=np.intp)
+    for i in np.flatnonzero(found):
+        keep = np.flatnonzero(in_region[i])[:k]
+        distances[i] = fetched_distances[i, keep]
+        neighbors[i] = fetched[i, keep]
+    if not found.all():
+        short = np.flatnonzero(~found)
+        distances[short], neighbors[short] = filtered_kneighbors(
+            X[short], candidates, k, X_all[candidates]
+        )
+    return distances, neighbors
+
+
+def query_neighbors(
+    advisor_IDs, region, k, backend="exact", mode="regional", chunk_size=10000
+):
+    # neighbors (and distances) of one or more advisors in a region; in global
+    # mode the full model is searched for neighbors in the region (exactly, or
+    # over-fetching from the approximate index of the backend)
+    model_region = "full" if mode == "global" else region
+    bundle = load_region(model_region, backend)
+    if isinstance(advisor_IDs, str):
+        advisor_IDs = [advisor_IDs]
+    rows = list()
+    for id_ in advisor_IDs:
+        if id_ not in bundle.index:
+            raise ValueError(f"{id_} is not in the {model_region} model")
+        rows.append(bundle.index[id_])
+
+    if model_region != region:
+        candidates = region_rows(bundle, region)
+        if backend == "exact":
+            distances, neighbors = filtered_kneighbors(
+                bundle.X_reduced[rows], candidates, k, bundle.X_reduced[candidates]
+            )
+        else:
+            distances, neighbors = overfetch_kneighbors(
+                bundle.model, bundle.X_reduced[rows], candidates, k, bundle.X_reduced
+            )
+    elif backend == "exact":
+        distances, neighbors = kneighbors(bundle.serving, bundle.X_reduced[rows], k)
+    else:
+        X = bundle.X_reduced[rows]
+
+        # query in chunks to bound the size of the distance matrices
+        distances = np.empty((len(rows), k))
+        neighbors = np.empty((len(rows), k), dtype=np.intp)
+        for start in range(0, len(rows), chunk_size):
+            stop = start + chunk_size
+            distances[start:stop], neighbors[start:stop] = bundle.model.kneighbors(
+                X[start:stop], k
+            )
 
     neighbors_df = pd.DataFrame()
-    neighbors_df["ID"] = [advisor_ID] * k
-    neighbors_df["neighbor"] = np.arange(k)
-    neighbors_df["neighbor_ID"] = neighbors[0]
+    neighbors_df["ID"] = np.repeat(np.asarray(advisor_IDs, dtype=object), k)
+    neighbors_df["neighbor"] = np.tile(np.arange(k), len(rows))
+    neighbors_df["neighbor_ID"] = bundle.ids[neighbors.ravel()]
+    neighbors_df["distance"] = distances.ravel()
 
     return neighbors_df
 
 
+def get_neighbors(advisor_ID, region, k, backend="exact", mode="regional"):
+    neighbors_df = query_neighbors(advisor_ID, region, k, backend, mode)
+    return neighbors_df.drop("distance", axis=1)
+
+
+def get_region_neighbors(region, k, backend="exact", mode="regional"):
+    if mode == "global" and region != "full":
+        bundle = load_region("full", backend)
+        ids = bundle.ids[region_rows(bundle, region)]
+    else:
+        ids = load_region(region, backend).ids
+    return get_neighbors(ids, region, k, backend, mode)
+
+
 def get_id_name_state(df, region):
     if region == "full":
         output = df.loc[:, ["name", "1D", "1F1-State"]]
     else:
         output = df.loc[df["region"] == region, ["name", "1D", "1F1-State"]]
-    output = output.replace(np.nan, "Foreign")
+    # (IDs and states are categoricals, which can't take a new value)
+    output = output.astype(object).replace(np.nan, "Foreign")
     output["name"] = output.apply(lambda x: f"{x['name']} ({x['1F1-State']})", axis=1)
     output = output.drop("1F1-State", axis=1)
     output.columns = ["Name", "ID"]
@@ -50,44 +228,56 @@ def get_id_name_state(df, region):
     return output
 
 
+def get_name_search(lookup):
+    # lowercase words of each name (without the state appended to it), so names
+    # can be searched by word prefix
+    names = lookup["Name"].str.replace(r" \([^()]*\)$", "", regex=True)
+    words = names.str.lower().str.findall(r"\w+")
+    search = pd.DataFrame({"word": words, "Name": lookup["Name"]}).explode("word")
+    return search.dropna().drop_duplicates()
+
+
+# columns shown in the dashboard (in order)
+report_cols = [
+    "1D",
+    "name",
+    "1F1-State",
+    "5F2a",
+    "5F2b",
+    "5F2c",
+    "5F2d",
+    "5F2e",
+    "5F2f",
+    "5H",
+    "5B1",
+    "5B3",
+    "5B2",
+    "5B4",
+    "5B5",
+    "5B6",
+    "assets_per_advisor",
+    "clients_per_advisor",
+    "assets_per_client",
+    "disc_to_total_assets",
+    "advisor_growth_1y",
+    "advisor_growth_3y",
+    "asset_growth_1y",
+    "asset_growth_3y",
+    "assets_per_advisor_growth_1y",
+    "assets_per_advisor_growth_3y",
+    "clients_per_advisor_growth_1y",
+    "clients_per_advisor_growth_3y",
+    "assets_per_client_growth_1y",
+    "assets_per_client_growth_3y",
+    "disc_to_total_assets_growth_1y",
+    "disc_to_total_assets_growth_3y",
+]
+
+
 def format_df(df):
-    order = [
-        "1D",
-        "name",
-        "1F1-State",
-        "5F2a",
-        "5F2b",
-        "5F2c",
-        "5F2d",
-        "5F2e",
-        "5F2f",
-        "5H",
-        "5B1",
-        "5B3",
-        "5B2",
-        "5B4",
-        "5B5",
-        "5B6",
-        "assets_per_advisor",
-        "clients_per_advisor",
-        "assets_per_client",
-        "disc_to_total_assets",
-        "advisor_growth_1y",
-        "advisor_growth_3y",
-        "asset_growth_1y",
-        "asset_growth_3y",
-        "assets_per_advisor_growth_1y",
-        "assets_per_advisor_growth_3y",
-        "clients_per_advisor_growth_1y",
-        "clients_per_advisor_growth_3y",
-        "assets_per_client_growth_1y",
-        "assets_per_client_growth_3y",
-        "disc_to_total_assets_growth_1y",
-        "disc_to_total_assets_growth_3y",
-    ]
-    df = df[order]
+    df = df[report_cols]
 
-    df.iloc[:, 2] = df.iloc[:, 2].replace(np.nan, "Foreign").astype(str)
+    df.iloc[:, 2] = df.iloc[:, 2].astype(object).replace(np.nan, "Foreign").astype(str)
 
     plan = {
         0: "0",
@@ -142,31 +332,97 @@ def format_df(df):
     return df
 
 
-def create_dashboard_data():
-    con = db.connect(f"{app_dir}/dashboard/data/advisor_similarity.db")
+def get_ecdf_data(formatted, lookup):
+    # sorted values and percentiles (as px.ecdf computes them) of each numeric
+    # column so the dashboard doesn't have to sort them on every callback
+    data = lookup.merge(formatted, on="ID")
+    ecdf = list()
+    for column in formatted.select_dtypes("number").columns:
+        values = data.loc[np.isfinite(data[column]), ["ID", column]]
+        values = values.sort_values(by=column)
+        n = len(values)
+        col_ecdf = pd.DataFrame()
+        col_ecdf["column"] = [column] * n
+        col_ecdf["x"] = values[column].values
+        col_ecdf["y"] = 100.0 * np.arange(1, n + 1) / n
+        col_ecdf["ID"] = values["ID"].values
+        ecdf.append(col_ecdf)
+    return pd.concat(ecdf, ignore_index=True)
+
 
-    df = pd.read_hdf(f"{app_dir}/data/reporting/reporting_data.h5")
+def write_region(con, region, region_neighbors, df, formatted):
+    # the neighbors, names and ECDFs of a region, with the indexes the dashboard
+    # looks rows up by
+    region_neighbors.to_sql(
+        f"neighbors_{region}", con, if_exists="replace", index=False
+    )
+    lookup = get_id_name_state(df, region)
+    lookup.to_sql(f"ID_lookup_{region}", con, if_exists="replace", index=False)
+    get_name_search(lookup).to_sql(
+        f"name_search_{region}", con, if_exists="replace", index=False
+    )
+    get_ecdf_data(formatted, lookup).to_sql(
+        f"ecdf_{region}", con, if_exists="replace", index=False
+    )
+
+    con.execute(
+        f"create index ix_neighbors_{region} on neighbors_{region} (ID, neighbor)"
+    )
+    con.execute(f"create index ix_ID_lookup_{region} on ID_lookup_{region} (Name)")
+    con.execute(f"create index ix_ID_lookup_{region}_ID on ID_lookup_{region} (ID)")
+    con.execute(f'create index ix_ecdf_{region} on ecdf_{region} ("column")')
+    con.execute(
+        f"create index ix_name_search_{region} on name_search_{region} (word, Name)"
+    )
 
-    format_df(df).to_sql(
-        "reporting_data_formatted", con, if_exists="replace", index=False
+
+def create_dashboard_data(workers=1, backend="exact", mode="regional"):
+    df = read_frame(
+        f"{app_dir}/data/reporting/reporting_data",
+        columns=report_cols + ["region"],
+        schema="reporting_data",
     )
+    formatted = format_df(df)
 
+    # get regions ("full" first since it is the longest task)
     regions = df["region"].drop_duplicates().tolist()
-    regions.append("full")
-
-    for region in regions:
-        region_neighbors = pd.DataFrame()
-        ids = load(f"{app_dir}/data/engineered/ID_{region}.pkl")
-        for id_ in tqdm(ids, desc=f"{region}: "):
-            adv_neighbors = get_neighbors(id_, region, 21)
-            region_neighbors = region_neighbors.append(adv_neighbors, ignore_index=True)
-        region_neighbors.to_sql(
-            f"neighbors_{region}", con, if_exists="replace", index=False
-        )
-        get_id_name_state(df, region).to_sql(
-            f"ID_lookup_{region}", con, if_exists="replace", index=False
+    regions.insert(0, "full")
+
+    # the connection (and the pool of workers, if any) are closed even if a
+    # region fails
+    with ExitStack() as stack:
+        con = db.connect(f"{app_dir}/dashboard/data/advisor_similarity.db")
+        stack.callback(con.close)
+
+        with profiling.step("sqlite write", rows_in=len(formatted)):
+            formatted.to_sql(
+                "reporting_data_formatted", con, if_exists="replace", index=False
+            )
+        con.execute(
+            "create index ix_reporting_data_formatted on reporting_data_formatted (ID)"
         )
-    con.close()
+
+        # neighbors are computed in worker processes (if any) but all writes
+        # happen here, in region order, so there is a single writer to the database
+        if workers > 1:
+            executor = stack.enter_context(ProcessPoolExecutor(workers))
+            results = executor.map(
+                get_region_neighbors, regions, repeat(21), repeat(backend), repeat(mode)
+            )
+        else:
+            results = map(
+                get_region_neighbors, regions, repeat(21), repeat(backend), repeat(mode)
+            )
+
+        for region in tqdm(regions):
+            with profiling.step(region):
+                # (with workers this waits for the region's neighbors)
+                with profiling.step("neighbors") as record:
+                    region_neighbors = next(results)
+                    record["rows_out"] = len(region_neighbors)
+                with profiling.step("sqlite write", rows_in=len(region_neighbors)):
+                    write_region(con, region, region_neighbors, df, formatted)
+        con.commit()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import re
+import numpy as np
+
+
+# compact dtypes of the intermediate frames, applied when they are read and
+# enforced when they are written (see storage); columns are matched by pattern,
+# the first match wins and columns that match none keep their dtype
+categorical_cols = r"^1D$|^1F1-State$|^region$"
+count_cols = r"^5A$|^5A-Number$|^5B\d$|^5B\d-Number$"
+asset_cols = r"^5F2[a-f]$"
+ratio_cols = r"_per_|_to_|_growth_"
+
+# counts stay float32 (exact for whole numbers below 2**24) since they can be
+# missing, while assets and accounts stay float64 since they can be larger than
+# float32 represents exactly; the features are clipped to (fractional) quantiles,
+# so they are all float32
+schemas = {
+    "selected_data": [
+        (categorical_cols, "category"),
+        (count_cols, "float32"),
+        (asset_cols, "float64"),
+    ],
+    "reporting_data": [
+        (categorical_cols, "category"),
+        (count_cols, "float32"),
+        (asset_cols, "float64"),
+        (r"^5H$", "int16"),
+        (ratio_cols, "float32"),
+    ],
+    "unscaled_features": [
+        (categorical_cols, "category"),
+        (r".", "float32"),
+    ],
+}
+
+
+def column_dtypes(columns, frame):
+    dtypes = dict()
+    for col in columns:
+        for pattern, dtype in schemas[frame]:
+            if re.search(pattern, col):
+                dtypes[col] = dtype
+                break
+    return dtypes
+
+
+def apply_schema(df, frame):
+    # categories are the sorted values present, so a frame and its copy on disk
+    # compare equal; integer columns must hold whole numbers in range
+    df = df.copy(deep=False)
+    for col, dtype in column_dtypes(df.columns, frame).items():
+        if dtype == "category":
+            values = df[col].astype("category", copy=False)
+            df[col] = values.cat.set_categories(
+                sorted(values.cat.remove_unused_categories().cat.categories)
+            )
+        elif np.issubdtype(np.dtype(dtype), np.integer):
+            cast = df[col].fillna(0).astype(dtype)
+            if df[col].isna().any() or not np.array_equal(cast, df[col]):
+                raise ValueError(f"{col} does not fit in {dtype}")
+            df[col] = cast
+        elif df[col].dtype != dtype:
+            df[col] = df[col].astype(dtype)
+    return df
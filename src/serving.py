@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+import json
+import os
+import numpy as np
+from src.settings import app_dir
+
+
+# everything needed to answer a query with NumPy alone: the scaler (mean, scale)
+# and PCA (center, components) parameters plus the projected points, their
+# squared norms and their IDs
+ServingBundle = namedtuple(
+    "ServingBundle",
+    ["mean", "scale", "center", "components", "points", "norms", "ids"],
+)
+
+
+def squared_distances(X, Y):
+    # squared euclidean distances between the rows of X and Y
+    d = (X**2).sum(axis=1)[:, None] - 2 * X @ Y.T + (Y**2).sum(axis=1)[None, :]
+    return np.maximum(d, 0)
+
+
+def squared_norms(points, chunk_size=100000):
+    # (in float64, a chunk at a time, so memory-mapped points aren't copied whole)
+    norms = np.empty(len(points), dtype=np.float32)
+    for start in range(0, len(points), chunk_size):
+        chunk = np.asarray(points[start : start + chunk_size], dtype=np.float64)
+        norms[start : start + chunk_size] = (chunk**2).sum(axis=1)
+    return norms
+
+
+def save_bundle(region, scaler, reducer, points):
+    # the projected points and IDs are saved by the pipeline as .npy files
+    np.savez(
+        f"{app_dir}/models/serving_{region}.npz",
+        mean=scaler.mean_,
+        scale=scaler.scale_,
+        center=reducer.mean_,
+        components=reducer.components_,
+        norms=squared_norms(points),
+    )
+
+
+def load_bundle(region):
+    params = np.load(f"{app_dir}/models/serving_{region}.npz")
+    points = np.load(f"{app_dir}/data/engineered/Z_{region}.npy", mmap_mode="r")
+    return ServingBundle(
+        params["mean"],
+        params["scale"],
+        params["center"],
+        params["components"],
+        points,
+        params["norms"] if "norms" in params else squared_norms(points),
+        np.load(f"{app_dir}/data/engineered/ID_{region}.npy", mmap_mode="r"),
+    )
+
+
+def save_build(mode, backend, regions):
+    # what the models were last built as, so queries can't be answered by models
+    # left over from an earlier build
+    with open(f"{app_dir}/models/build.json", "w") as fh:
+        json.dump({"mode": mode, "backend": backend, "regions": regions}, fh, indent=2)
+
+
+def load_build():
+    path = f"{app_dir}/models/build.json"
+    if not os.path.exists(path):
+        return None
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def project(bundle, X):
+    # scale and reduce (unscaled) feature rows
+    X = np.asarray(X, dtype=np.float64)
+    X = (X - bundle.mean) / bundle.scale
+    return (X - bundle.center) @ bundle.components.T
+
+
+def kneighbors(bundle, X, k, chunk_size=1000, margin=8):
+    # exact k nearest points to each projected row of X (ties broken by row); the
+    # nearest points (and a margin of the next ones, in case rounding swapped
+    # them) are found in float32 straight off the (memory-mapped) points and the
+    # saved norms, and only their distances are computed in float64
+    X = np.asarray(X, dtype=np.float64)
+    k = min(k, len(bundle.points))
+    fetch = min(k + margin, len(bundle.points))
+    distances = np.empty((len(X), k))
+    neighbors = np.empty((len(X), k), dtype=np.intp)
+    for start in range(0, len(X), chunk_size):
+        stop = start + chunk_size
+        x = X[start:stop]
+
+        # (the norm of x is the same for each of its points, so it's left out)
+        d = bundle.norms[None, :] - 2 * (x.astype(np.float32) @ bundle.points.T)
+        top = np.argpartition(d, fetch - 1, axis=1)[:, :fetch]
+        d = ((np.asarray(bundle.points[top], np.float64) - x[:, None]) ** 2).sum(2)
+        order = np.lexsort((top, d), axis=1)[:, :k]
+        distances[start:stop] = np.sqrt(np.take_along_axis(d, order, axis=1))
+        neighbors[start:stop] = np.take_along_axis(top, order, axis=1)
+    return distances, neighbors
+
+
+def query(bundle, advisor_IDs, k):
+    # neighbor IDs and distances of advisors in the bundle's region
+    rows = np.flatnonzero(np.isin(bundle.ids, advisor_IDs))
+    index = dict()
+    for row in rows:
+        index.setdefault(bundle.ids[row], row)
+    missing = [id_ for id_ in advisor_IDs if id_ not in index]
+    if len(missing) > 0:
+        raise ValueError(f"{missing} not in the model")
+    rows = [index[id_] for id_ in advisor_IDs]
+    distances, neighbors = kneighbors(bundle, bundle.points[rows], k)
+    return bundle.ids[neighbors], distances
+
+
+def verify(region, k=21, n_queries=1000, random_state=0, atol=1e-5):
+    # compares the NumPy engine to the sklearn model on a sample of advisors;
+    # neighbors may only differ where distances tie. Returns the mismatched rows
+    from joblib import load
+
+    bundle = load_bundle(region)
+    model = load(f"{app_dir}/models/model_{region}.pkl")
+    rng = np.random.default_rng(random_state)
+    rows = rng.choice(len(bundle.points), min(n_queries, len(bundle.points)), False)
+    X = bundle.points[rows]
+    k = min(k, len(bundle.points))
+    distances, neighbors = kneighbors(bundle, X, k)
+    expected_distances, expected_neighbors = model.kneighbors(
+        X, min(k + 1, len(bundle.points))
+    )
+
+    # the projection of the unscaled features must also reproduce the points
+    # (they aren't saved for the full model in global mode, but are in the order
+    # of the unscaled features then)
+    path = f"{app_dir}/data/engineered/X_{region}.npy"
+    if os.path.exists(path):
+        X_raw = np.load(path, mmap_mode="r")[rows]
+    else:
+        from src.storage import read_frame
+
+        df = read_frame(
+            f"{app_dir}/data/engineered/unscaled_features", schema="unscaled_features"
+        )
+        X_raw = df.drop(["1D", "region"], axis=1).to_numpy(np.float32)[rows]
+    if not np.allclose(project(bundle, X_raw), X, atol=atol):
+        raise ValueError(f"projection does not reproduce the {region} points")
+
+    # a neighbor may only differ where its distance ties with an adjacent one (the
+    # last one may tie with the first neighbor left out)
+    gaps = np.isclose(np.diff(expected_distances, axis=1), 0, atol=atol)
+    gaps = np.hstack([gaps, np.zeros((len(rows), k - gaps.shape[1]), dtype=bool)])
+    expected_distances = expected_distances[:, :k]
+    expected_neighbors = expected_neighbors[:, :k]
+    first = np.zeros((len(rows), 1), dtype=bool)
+    tied = np.hstack([first, gaps[:, : k - 1]]) | gaps[:, :k]
+    close = np.isclose(distances, expected_distances, atol=atol)
+    same = close & ((neighbors == expected_neighbors) | tied)
+    return rows[~same.all(axis=1)]
@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+
+# directory the pipeline reads its data from and writes it to; RIA_APP_DIR points
+# it at another copy of the data directories (e.g. the synthetic data of the
+# benchmarks or tests). It is read once, when src is first imported
+app_dir = os.environ.get(
+    "RIA_APP_DIR", os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+)
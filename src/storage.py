@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from src.schema import apply_schema
+
+
+# intermediate frames are stored as directories of Parquet files partitioned
+# (hive style, e.g. region=Mideast/...) by some of their columns so that a read
+# can skip the partitions and columns it doesn't need; the row order and index of
+# the frame are kept in extra columns
+row_col = "_row"
+index_col = "_index"
+year_col = "filing_year"
+
+
+def write_frame(df, path, partition_cols=(), year_from=None, schema=None):
+    # year_from also partitions by the year of a date column (e.g. filing year);
+    # schema names the frame's dtypes in src.schema
+    if schema is not None:
+        df = apply_schema(df, schema)
+
+    # the row order and index are added as Arrow columns (rather than to a copy
+    # of the frame)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.append_column(row_col, pa.array(np.arange(len(df))))
+    table = table.append_column(index_col, pa.array(df.index.to_numpy()))
+    partition_cols = list(partition_cols)
+    if year_from is not None:
+        years = df[year_from].dt.year.to_numpy()
+        table = table.append_column(year_col, pa.array(years))
+        partition_cols.append(year_col)
+
+    # partition columns are saved in the directory names (as strings), so the
+    # column order and their dtypes are saved alongside (in a file the Parquet
+    # reader skips) to restore them on read
+    frame = {
+        "columns": df.columns.tolist(),
+        "dtypes": {col: str(df[col].dtype) for col in partition_cols if col in df},
+    }
+
+    # write next to the old copy and swap it in once complete
+    tmp = f"{path}.tmp"
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    if len(partition_cols) > 0:
+        pq.write_to_dataset(table, tmp, partition_cols=partition_cols)
+    else:
+        os.makedirs(tmp)
+        pq.write_table(table, f"{tmp}/part-0.parquet")
+    with open(f"{tmp}/_frame.json", "w") as fh:
+        json.dump(frame, fh, indent=2)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp, path)
+
+
+def read_frame(path, columns=None, filters=None, schema=None):
+    # columns are projected and filters (e.g. [("region", "=", "Mideast")]) are
+    # pushed down to the partitions and row groups; schema names the frame's
+    # dtypes in src.schema
+    if columns is not None:
+        columns = list(columns) + [row_col, index_col]
+    table = pq.read_table(path, columns=columns, filters=filters)
+    with open(f"{path}/_frame.json") as fh:
+        frame = json.load(fh)
+
+    # put the rows back in order and in their column order before converting,
+    # then convert a column at a time (releasing the Arrow memory as it goes) so
+    # that the frame is never copied
+    table = table.take(pc.sort_indices(table, [(row_col, "ascending")]))
+    index = pd.Index(table.column(index_col).to_numpy())
+    table = table.select([col for col in frame["columns"] if col in table.column_names])
+    df = table.to_pandas(split_blocks=True, self_destruct=True)
+    del table
+    df.index = index
+
+    for col, dtype in frame["dtypes"].items():
+        if col in df:
+            df[col] = df[col].astype(dtype)
+    return df if schema is None else apply_schema(df, schema)
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+
+# synthetic Form ADV filings shaped like the SEC's IA_ADV_Base_A files, for
+# running (and benchmarking) the pipeline offline; each adviser has a profile
+# (office, size, client base) that drifts from year to year, files about once a
+# year (sometimes with amendments) and may start or stop filing part way through
+
+# main office states, weighted roughly by where advisers are (missing and
+# territories end up in the Foreign region)
+# fmt: off
+states = {
+    "NY": 12, "CA": 14, "TX": 7, "FL": 7, "IL": 4, "MA": 4, "NJ": 4, "PA": 4,
+    "CT": 3, "OH": 3, "GA": 3, "CO": 2, "WA": 2, "MN": 2, "MO": 2, "MI": 2,
+    "NC": 2, "VA": 2, "MD": 2, "AZ": 2, "WI": 1, "TN": 1, "OR": 1, "UT": 1,
+    "IN": 1, "KS": 1, "IA": 1, "NE": 1, "OK": 1, "NM": 1, "NV": 1, "SC": 1,
+    "AL": 1, "KY": 1, "LA": 1, "NH": 1, "ME": 1, "RI": 1, "VT": 1, "DE": 1,
+    "DC": 1, "HI": 1, "ID": 1, "MT": 1, "WY": 1, "ND": 1, "SD": 1, "AK": 1,
+    "AR": 1, "MS": 1, "WV": 1, "PR": 1, "GU": 1, "VI": 1, "": 2,
+}
+# fmt: on
+
+# adviser names are made up of a surname-like word (from syllables), a business
+# word and a suffix
+# fmt: off
+syllables = [
+    "al", "an", "ar", "ber", "bro", "cal", "car", "den", "dor", "el", "fer",
+    "gan", "hal", "har", "in", "kel", "ker", "lan", "ley", "lin", "mar", "mon",
+    "nor", "os", "per", "ran", "ros", "son", "ton", "ver", "wel", "win",
+]
+business_words = [
+    "Capital", "Wealth", "Financial", "Asset", "Investment", "Advisory",
+    "Planning", "Retirement", "Private", "Family",
+]
+# fmt: on
+suffixes = ["Management", "Advisors", "Partners", "Group", "Counsel", "Services"]
+legal_forms = [", LLC", ", Inc.", " LLC", ", LP", " & Co."]
+
+# how often advisers check each 5G box (5G2-5G4 decide the retail scope)
+compensation = [0.2, 0.85, 0.15, 0.1, 0.3, 0.1, 0.05, 0.05, 0.05, 0.1, 0.05, 0.02]
+
+# 5H (financial planning clients) ranges by the lower end of each range
+planning = [
+    (0, "0"),
+    (1, "1-10"),
+    (11, "11-25"),
+    (26, "26-50"),
+    (51, "51-100"),
+    (101, "101-250"),
+    (251, "251-500"),
+    (501, "More than 500"),
+]
+
+
+def create_app_dirs(path):
+    # directories the pipeline reads from and writes to
+    for d in [
+        "data/raw/SEC",
+        "data/processed",
+        "data/engineered",
+        "data/reporting",
+        "models",
+        "dashboard/data",
+    ]:
+        os.makedirs(f"{path}/{d}", exist_ok=True)
+
+
+def create_advisers(n, start_year, end_year, rng):
+    # the profile of each adviser (at its first filing) and its filing span
+    width = max(5, len(str(n - 1)))
+    ids = np.char.add("801-", np.char.zfill(np.arange(n).astype(str), width))
+
+    surname = np.char.add(
+        np.char.add(rng.choice(syllables, n), rng.choice(syllables, n)),
+        np.where(rng.random(n) < 0.5, rng.choice(syllables, n), ""),
+    )
+    dba = np.char.add(
+        np.char.add(np.char.capitalize(surname), " "),
+        np.char.add(
+            np.char.add(rng.choice(business_words, n), " "), rng.choice(suffixes, n)
+        ),
+    )
+    legal = np.char.add(dba, rng.choice(legal_forms, n))
+
+    weights = np.array(list(states.values()), dtype=float)
+    state = rng.choice(list(states), n, p=weights / weights.sum())
+
+    # half the advisers were already registered when the data starts, and a few
+    # deregister before it ends
+    first_year = np.where(
+        rng.random(n) < 0.5, start_year, rng.integers(start_year, end_year + 1, n)
+    )
+    last_year = np.where(
+        rng.random(n) < 0.08,
+        rng.integers(first_year, end_year + 1),
+        end_year,
+    )
+
+    advisors = np.ceil(rng.lognormal(0.8, 1.0, n))
+    assets = advisors * rng.lognormal(17.5, 1.2, n)
+    return pd.DataFrame(
+        {
+            "1D": ids,
+            "1E1": 100_000 + np.arange(n),
+            "1A": legal,
+            "1B": np.where(rng.random(n) < 0.6, dba, ""),
+            "1F1-State": state,
+            "first_year": first_year,
+            "last_year": last_year,
+            "advisors": advisors,
+            "staff": np.ceil(advisors * rng.uniform(1.0, 2.5, n)),
+            "brokers": np.floor(
+                advisors * rng.uniform(0, 1, n) * (rng.random(n) < 0.4)
+            ),
+            "assets": assets,
+            "per_client": rng.lognormal(13.5, 1.0, n),
+            "discretionary": rng.beta(5, 1.5, n),
+            "growth": rng.normal(0.04, 0.08, n),
+            "planning": rng.random(n) < 0.6,
+            **{f"5G{i + 1}": rng.random(n) < p for i, p in enumerate(compensation)},
+        }
+    )
+
+
+def create_filings(advisers, year, rng, renamed_from=2018):
+    # the filings of the advisers registered in a year: about one per adviser, a
+    # few with an amendment, and some with a missing SEC number
+    registered = advisers.loc[
+        (advisers["first_year"] <= year) & (advisers["last_year"] >= year), :
+    ]
+    filed = registered.loc[rng.random(len(registered)) < 0.92, :]
+    counts = 1 + (rng.random(len(filed)) < 0.25)
+    df = filed.loc[filed.index.repeat(counts), :].reset_index(drop=True)
+    n = len(df)
+
+    # drift the profile by the adviser's growth since its first filing
+    drift = (1 + df["growth"]) ** (year - df["first_year"])
+    noise = rng.lognormal(0, 0.05, n)
+    advisors = np.maximum(np.round(df["advisors"] * drift * noise), 0)
+    assets = np.round(df["assets"] * drift * noise)
+    clients = np.maximum(np.round(assets / df["per_client"]), 1)
+    discretionary = np.round(assets * df["discretionary"])
+    disc_clients = np.round(clients * df["discretionary"])
+
+    seconds = rng.integers(0, 365 * 24 * 3600, n)
+    submitted = pd.Timestamp(year, 1, 1) + pd.to_timedelta(seconds, unit="s")
+    missing_id = rng.random(n) < 0.001
+
+    # employee counts moved to "-Number" columns part way through
+    suffix = "-Number" if year >= renamed_from else ""
+    bins = [lower for lower, _ in planning]
+    labels = np.array([label for _, label in planning], dtype=object)
+    planned = clients * rng.uniform(0, 0.8, n)
+    planned = labels[np.searchsorted(bins, planned, side="right") - 1]
+
+    # columns in the order of the SEC's files, with the submission date third
+    filings = pd.DataFrame(
+        {
+            "FilingID": rng.integers(1_000_000, 9_999_999, n),
+            "1E1": df["1E1"],
+            "DateSubmitted": submitted.strftime("%m/%d/%Y %I:%M:%S %p"),
+            "1A": df["1A"],
+            "1B": df["1B"].replace("", np.nan),
+            "1B1": np.nan,
+            "1C": "N",
+            "1D": np.where(missing_id, "801-", df["1D"]),
+            "1F1-State": df["1F1-State"].replace("", np.nan),
+            "1F1-Country": "United States",
+            f"5A{suffix}": np.maximum(
+                np.round(df["staff"] * drift * noise), advisors
+            ).astype(int),
+            f"5B1{suffix}": advisors.astype(int),
+            f"5B2{suffix}": np.round(df["brokers"] * drift).astype(int),
+            f"5B3{suffix}": advisors.astype(int),
+            "5B4": np.round(df["brokers"] * drift * 0.8).astype(int),
+            "5B5": (rng.random(n) < 0.3) * rng.integers(1, 5, n),
+            "5B6": (rng.random(n) < 0.05) * rng.integers(1, 3, n),
+            "5F2a": discretionary.astype("int64"),
+            "5F2b": (assets - discretionary).astype("int64"),
+            "5F2c": pd.array(assets, dtype="Int64"),
+            "5F2d": disc_clients.astype("int64"),
+            "5F2e": (clients - disc_clients).astype("int64"),
+            "5F2f": clients.astype("int64"),
+            **{
+                f"5G{i + 1}": np.where(df[f"5G{i + 1}"], "Y", "N")
+                for i in range(len(compensation))
+            },
+            "5H": np.where(df["planning"], planned, None),
+            "9A": "N",
+        }
+    )
+
+    # some filings leave total assets blank
+    filings.loc[rng.random(n) < 0.02, "5F2c"] = pd.NA
+    return filings
+
+
+def write_filings(
+    path, advisers=10000, years=8, end_year=2021, seed=0, chunk_size=100_000
+):
+    # writes a year of filings per file to the SEC directory of the app directory
+    # at path, returning the number of filings written
+    rng = np.random.default_rng(seed)
+    create_app_dirs(path)
+    sec_dir = f"{path}/data/raw/SEC/synthetic"
+    os.makedirs(sec_dir, exist_ok=True)
+
+    start_year = end_year - years + 1
+    advisers = create_advisers(advisers, start_year, end_year, rng)
+    rows = 0
+    for year in range(start_year, end_year + 1):
+        f = f"{sec_dir}/IA_ADV_Base_A_{year}0101_{year}1231.csv"
+        for i, start in enumerate(range(0, len(advisers), chunk_size)):
+            chunk = advisers.iloc[start : start + chunk_size]
+            filings = create_filings(chunk, year, rng)
+            filings.to_csv(
+                f,
+                mode="w" if i == 0 else "a",
+                header=i == 0,
+                index=False,
+                encoding="ISO-8859-1",
+            )
+            rows += len(filings)
+    return rows
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Write synthetic Form ADV (Base A) filings"
+    )
+    parser.add_argument("path", help="app directory to write data/raw/SEC into")
+    parser.add_argument("--advisers", type=int, default=10000)
+    parser.add_argument("--years", type=int, default=8, help="years of filings")
+    parser.add_argument("--end-year", type=int, default=2021)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rows = write_filings(
+        args.path, args.advisers, args.years, args.end_year, args.seed
+    )
+    print(f"{rows} filings of {args.advisers} advisers written to {args.path}")
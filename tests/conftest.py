@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import tempfile
+import pytest
+
+# the src modules read RIA_APP_DIR when they are first imported, so the tests
+# point it at a scratch app directory before any of them is imported
+os.environ["RIA_APP_DIR"] = tempfile.mkdtemp(prefix="ria-tests-")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def pipeline_dir():
+    # the pipeline run once on synthetic filings (with the approximate index as
+    # well), shared by the tests that need its artifacts
+    from src.settings import app_dir
+    from src.synthetic_data import write_filings
+    from src.data_processing import process_data
+    from src.feature_engineering import engineer_features
+    from src.model_building import build_regional_models
+    from src.reporting import create_dashboard_data
+
+    write_filings(app_dir, advisers=2000, years=5, seed=0)
+    process_data()
+    engineer_features()
+    build_regional_models(backend="ivf")
+    create_dashboard_data()
+    return app_dir
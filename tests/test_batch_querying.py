@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+import pytest
+from src.batch_querying import query_batch
+from src.reporting import load_region
+
+
+@pytest.mark.parametrize("rank", [False, True])
+@pytest.mark.parametrize("extension", ["csv", "parquet"])
+def test_query_batch_without_known_advisors(pipeline_dir, tmp_path, rank, extension):
+    # the output is written with just its header when no ID is in the model
+    output = tmp_path / f"neighbors.{extension}"
+    unknown = query_batch(["801-nope"], "full", 5, str(output), rank=rank)
+    assert unknown == ["801-nope"]
+    if extension == "csv":
+        df = pd.read_csv(output)
+    else:
+        df = pd.read_parquet(output)
+    assert len(df) == 0
+    if rank:
+        columns = ["neighbor_ID", "count", "mean_distance", "best_rank"]
+        assert list(df.columns) == columns
+    else:
+        assert list(df.columns) == ["ID", "neighbor", "neighbor_ID", "distance"]
+
+
+@pytest.mark.parametrize("mode", ["regional", "global"])
+def test_query_batch_skips_advisors_outside_the_region(pipeline_dir, tmp_path, mode):
+    # an advisor in the full model but not in the region is unknown in both modes
+    bundle = load_region("full")
+    region = "Plains"
+    inside = bundle.ids[bundle.postings[region][:3]].tolist()
+    outside = np.setdiff1d(np.arange(len(bundle.ids)), bundle.postings[region])
+    outside = bundle.ids[outside[:2]].tolist()
+
+    output = tmp_path / "neighbors.csv"
+    unknown = query_batch(inside + outside, region, 5, str(output), mode=mode)
+    assert unknown == outside
+    df = pd.read_csv(output)
+    assert df["ID"].unique().tolist() == inside
+    assert set(df["neighbor_ID"]) <= set(bundle.ids[bundle.postings[region]])
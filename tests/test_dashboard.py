@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+import importlib.util
+import os
+import re
+import sqlite3 as db
+import pytest
+
+
+@pytest.fixture(scope="module")
+def dashboard(pipeline_dir):
+    # the dashboard app reading the database exported by the pipeline (it opens
+    # the database relative to the dashboard directory when it's imported)
+    path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "dashboard/app.py")
+    spec = importlib.util.spec_from_file_location("dashboard_app", path)
+    app = importlib.util.module_from_spec(spec)
+    cwd = os.getcwd()
+    os.chdir(f"{pipeline_dir}/dashboard")
+    try:
+        spec.loader.exec_module(app)
+    finally:
+        os.chdir(cwd)
+    app.db_location = f"{pipeline_dir}/dashboard/{app.db_location}"
+    return app
+
+
+def test_search_names_returns_each_name_once(dashboard):
+    # a name with several words starting with the search is listed once
+    for search in ["o", "a", "m"]:
+        names = dashboard.search_names("full", search)
+        assert len(names) > 0
+        assert len(names) == len(set(names))
+
+
+def test_search_names_skips_the_state(pipeline_dir, dashboard):
+    # the state appended to each name isn't searchable
+    con = db.connect(f"{pipeline_dir}/dashboard/data/advisor_similarity.db")
+    names = [row[0] for row in con.execute("select Name from ID_lookup_full")]
+    con.close()
+    assert any(name.endswith(" (OH)") for name in names)
+    for name in dashboard.search_names("full", "oh"):
+        words = re.findall(r"\w+", name.rsplit(" (", 1)[0].lower())
+        assert any(word.startswith("oh") for word in words)
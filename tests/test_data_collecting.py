@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from src.data_collecting import download_file
+
+
+class ArchiveHandler(BaseHTTPRequestHandler):
+    # serves the server's archive with an ETag, answering conditional and range
+    # requests the way the SEC's server does; requests are recorded
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        headers = {"ETag": server.etag, "Last-Modified": server.last_modified}
+        if self.headers.get("If-None-Match") == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        body, status = server.archive, 200
+        byte_range = self.headers.get("Range")
+        if byte_range and self.headers.get("If-Range") in (None, server.etag):
+            start = int(byte_range.split("=")[1].rstrip("-"))
+            body, status = server.archive[start:], 206
+            headers["Content-Range"] = f"bytes {start}-{len(server.archive) - 1}/*"
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ArchiveHandler)
+    server.archive = bytes(range(256)) * 1000
+    server.etag = '"v1"'
+    server.last_modified = "Fri, 01 Oct 2021 00:00:00 GMT"
+    server.requests = list()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f"http://127.0.0.1:{server.server_port}/archive.zip"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def read_sidecar(path):
+    with open(f"{path}.json") as fh:
+        return json.load(fh)
+
+
+def test_download_then_not_modified(server, tmp_path):
+    path = tmp_path / "archive.zip"
+    assert download_file(server.url, str(path), chunk_size=4096)
+    assert path.read_bytes() == server.archive
+    assert read_sidecar(path) == {
+        "etag": server.etag,
+        "last_modified": server.last_modified,
+    }
+
+    # the second request is conditional and the copy on disk is kept
+    assert not download_file(server.url, str(path))
+    assert server.requests[-1]["If-None-Match"] == server.etag
+    assert server.requests[-1]["If-Modified-Since"] == server.last_modified
+    assert path.read_bytes() == server.archive
+
+
+def test_resume_partial_download(server, tmp_path):
+    # an interrupted download: part of the archive and the validators it had
+    path = tmp_path / "archive.zip"
+    (tmp_path / "archive.zip.part").write_bytes(server.archive[:1000])
+    with open(f"{path}.json", "w") as fh:
+        json.dump({"partial": {"etag": server.etag, "last_modified": None}}, fh)
+
+    assert download_file(server.url, str(path))
+    assert server.requests[-1]["Range"] == "bytes=1000-"
+    assert server.requests[-1]["If-Range"] == server.etag
+    assert path.read_bytes() == server.archive
+    assert not (tmp_path / "archive.zip.part").exists()
+    assert read_sidecar(path) == {
+        "etag": server.etag,
+        "last_modified": server.last_modified,
+    }
+
+
+def test_resume_after_the_archive_changed(server, tmp_path):
+    # the part is of an older archive, so the whole new one is sent instead
+    path = tmp_path / "archive.zip"
+    (tmp_path / "archive.zip.part").write_bytes(b"old" * 100)
+    with open(f"{path}.json", "w") as fh:
+        json.dump({"partial": {"etag": '"v0"', "last_modified": None}}, fh)
+
+    assert download_file(server.url, str(path))
+    assert server.requests[-1]["If-Range"] == '"v0"'
+    assert path.read_bytes() == server.archive
+    assert read_sidecar(path)["etag"] == server.etag
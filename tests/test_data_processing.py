@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+import os
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+from src import data_processing
+from src.data_processing import process_data
+from src.storage import read_frame
+from src.synthetic_data import write_filings
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    # an app directory of its own with a few years of filings, recording the raw
+    # files that are read
+    write_filings(str(tmp_path), advisers=50, years=3, seed=1)
+    monkeypatch.setattr(data_processing, "app_dir", str(tmp_path))
+    read = list()
+    read_raw_file = data_processing.read_raw_file
+
+    def recorded(path, f):
+        read.append(f)
+        return read_raw_file(path, f)
+
+    monkeypatch.setattr(data_processing, "read_raw_file", recorded)
+    sec_dir = tmp_path / "data" / "raw" / "SEC" / "synthetic"
+    return tmp_path, sec_dir, read
+
+
+def processed(app_dir):
+    return read_frame(
+        f"{app_dir}/data/processed/selected_data", schema="selected_data"
+    ).reset_index(drop=True)
+
+
+def test_incremental_run_reads_only_the_amended_file(app):
+    app_dir, sec_dir, read = app
+    process_data(incremental=True)
+    files = sorted(os.listdir(sec_dir))
+
+    # an amended file drops its last filing
+    lines = (sec_dir / files[1]).read_bytes().splitlines(keepends=True)
+    (sec_dir / files[1]).write_bytes(b"".join(lines[:-1]))
+    read.clear()
+    assert process_data(incremental=True)
+    assert read == [files[1]]
+    incremental = processed(app_dir)
+
+    process_data()
+    assert_frame_equal(incremental, processed(app_dir))
+
+
+def test_incremental_run_drops_a_removed_file(app):
+    app_dir, sec_dir, read = app
+    process_data(incremental=True)
+    files = sorted(os.listdir(sec_dir))
+
+    os.remove(sec_dir / files[0])
+    read.clear()
+    assert process_data(incremental=True)
+    assert read == []
+    incremental = processed(app_dir)
+
+    process_data()
+    assert_frame_equal(incremental, processed(app_dir))
+    read.clear()
+    assert not process_data(incremental=True)
+
+
+def test_synthetic_files_read_like_the_sec_files(app):
+    # the original reader parsed the submission date by position
+    _, sec_dir, _ = app
+    f = sorted(os.listdir(sec_dir))[0]
+    df = pd.read_csv(sec_dir / f, encoding="ISO-8859-1", parse_dates=[2])
+    assert df.columns[2] == "DateSubmitted"
+    assert pd.api.types.is_datetime64_any_dtype(df["DateSubmitted"])
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+from src import feature_engineering
+from src.feature_engineering import (
+    history_hashes,
+    resample_advisor,
+    resample_advisors,
+    update_resampled,
+)
+
+
+def filings():
+    # three advisors: one with a few years of filings (two of them on the same
+    # day), one that starts filing part way through and one with a single filing
+    # and no state
+    rows = [
+        ("801-1", "2017-03-01", "NY", 4, 1e8, 300),
+        ("801-1", "2018-02-15", "NY", 5, 1.2e8, 320),
+        ("801-1", "2018-02-15", "NY", 6, 1.3e8, 330),
+        ("801-1", "2019-06-30", "NY", 6, 1.1e8, 310),
+        ("801-1", "2020-12-01", "NY", 8, 1.6e8, 400),
+        ("801-2", "2019-01-10", "TX", 2, 3e7, 90),
+        ("801-2", "2019-12-15", "TX", 2, 3.5e7, 100),
+        ("801-2", "2020-11-20", "TX", 3, 4.5e7, 120),
+        ("801-3", "2020-10-05", None, 1, 5e6, 20),
+    ]
+    df = pd.DataFrame(
+        rows, columns=["1D", "DateSubmitted", "1F1-State", "5B3", "5F2c", "5F2f"]
+    )
+    df["DateSubmitted"] = pd.to_datetime(df["DateSubmitted"])
+    df["1D"] = df["1D"].astype("category")
+    df["1F1-State"] = df["1F1-State"].astype("category")
+    df["5B3"] = df["5B3"].astype("float32")
+    df["assets_per_advisor"] = df["5F2c"] / df["5B3"]
+    df["clients_per_advisor"] = df["5F2f"] / df["5B3"]
+    df["assets_per_client"] = df["5F2c"] / df["5F2f"]
+    df["disc_to_total_assets"] = np.linspace(0.5, 0.9, len(df))
+    return df
+
+
+def yearly_checkpoints(max_date, years=4):
+    return [pd.Timestamp(max_date) - pd.DateOffset(years=i) for i in range(years)]
+
+
+def test_resample_advisors_matches_legacy_engine():
+    df = filings()
+    max_date = pd.Timestamp("2020-12-31")
+    checkpoints = yearly_checkpoints(max_date)
+
+    legacy = pd.concat(
+        [
+            resample_advisor(df, advisor, checkpoints, max_date)
+            for advisor in df["1D"].drop_duplicates()
+        ],
+        ignore_index=True,
+    )
+    assert_frame_equal(resample_advisors(df, checkpoints), legacy)
+
+
+def test_update_resampled_after_a_new_month(monkeypatch):
+    # a month later, with a new filing of 801-1; 801-2 filed between its 2019
+    # checkpoint and where that checkpoint moved to, while nothing changed for
+    # 801-3 (whose cached row is only moved to the new checkpoint)
+    df = filings()
+    old = df.loc[df["DateSubmitted"] < "2020-12-01", :]
+    old_checkpoints = yearly_checkpoints("2020-11-30")
+    checkpoints = yearly_checkpoints("2020-12-31")
+    ts = resample_advisors(old, old_checkpoints)
+
+    resampled = list()
+
+    def resample(df, checkpoints):
+        resampled.extend(df["1D"].unique())
+        return resample_advisors(df, checkpoints)
+
+    monkeypatch.setattr(feature_engineering, "resample_advisors", resample)
+    updated = update_resampled(
+        ts, history_hashes(old), df, history_hashes(df), checkpoints, old_checkpoints
+    )
+    assert sorted(resampled) == ["801-1", "801-2"]
+    assert_frame_equal(updated, resample_advisors(df, checkpoints))
+
+
+def test_resample_advisors_skips_unused_categories():
+    # advisors left out of a categorical frame keep their category, but they
+    # aren't resampled and the rest resample as they would with object IDs
+    df = filings()
+    df = df.loc[df["1D"] != "801-3", :]
+    assert "801-3" in df["1D"].cat.categories
+    checkpoints = yearly_checkpoints("2020-12-31")
+    ts = resample_advisors(df, checkpoints)
+    assert set(ts["1D"]) == {"801-1", "801-2"}
+    expected = resample_advisors(df.assign(**{"1D": df["1D"].astype(str)}), checkpoints)
+    assert_frame_equal(ts.assign(**{"1D": ts["1D"].astype(str)}), expected)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import os
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import pytest
+from src import model_building, profiling, reporting, serving
+from src.model_building import build_regional_models, min_recall, report_recall
+from src.reporting import load_region, query_neighbors
+from src.storage import write_frame
+
+
+def test_recall_of_the_approximate_index_is_recorded(pipeline_dir):
+    # the pipeline's models are built with the ivf backend as well
+    recalls = [record["recall"] for record in profiling.records if "recall" in record]
+    assert len(recalls) > 0
+    assert all(0 < recall <= 1 for recall in recalls)
+
+
+def test_low_recall_is_pointed_out(capsys):
+    report_recall("Mideast", "ivf", {"recall": 0.99})
+    report_recall("Plains", "ivf", {"recall": min_recall - 0.1})
+    report_recall("Plains", "exact", dict())
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == "Mideast: ivf recall@21 of 0.990"
+    assert lines[1].startswith("Plains: ivf recall@21 of 0.850, below")
+    assert len(lines) == 2
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    # an app directory of its own with the unscaled features of a few regions
+    for module in [model_building, serving, reporting]:
+        monkeypatch.setattr(module, "app_dir", str(tmp_path))
+    monkeypatch.setattr(reporting, "region_cache", OrderedDict())
+    (tmp_path / "models").mkdir()
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(rng.normal(size=(300, 5)), columns=list("abcde"))
+    df = df.astype(np.float32)
+    df["1D"] = [f"801-{i}" for i in range(300)]
+    df["region"] = np.repeat(["Mideast", "Plains", "Southwest"], 100)
+    write_frame(
+        df,
+        f"{tmp_path}/data/engineered/unscaled_features",
+        schema="unscaled_features",
+    )
+    return tmp_path
+
+
+def test_global_build_removes_the_regional_models(app):
+    build_regional_models(backend="ivf")
+    assert len(load_region("Mideast", "ivf").ids) == 100
+
+    build_regional_models(mode="global")
+    left = sorted(os.listdir(app / "models"))
+    left += sorted(os.listdir(app / "data" / "engineered"))
+    assert not any("Mideast" in name or "ivf" in name for name in left)
+    assert not (app / "data" / "engineered" / "X_full.npy").exists()
+    with pytest.raises(ValueError, match="global mode"):
+        load_region("Mideast")
+    with pytest.raises(ValueError, match="ivf"):
+        load_region("full", "ivf")
+    neighbors = query_neighbors(["801-0"], "Mideast", 5, mode="global")
+    assert neighbors["neighbor_ID"].isin([f"801-{i}" for i in range(100)]).all()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from src.feature_engineering import engineer_features
+from src.orchestrating import (
+    Stage,
+    dependencies,
+    sort_stages,
+    source_modules,
+    stage_key,
+)
+
+
+def test_source_modules_follow_imports():
+    names = [module.__name__ for module in source_modules(engineer_features)]
+    assert "src.feature_engineering" in names
+    assert "src.schema" in names
+    assert "src.storage" in names
+
+
+def test_stage_key_changes_with_imported_module(tmp_path, monkeypatch):
+    # a stage in one module of a package that calls a helper from another one
+    package = tmp_path / "stagepkg"
+    package.mkdir()
+    (package / "__init__.py").write_text("")
+    (package / "helpers.py").write_text("def double(x):\n    return 2 * x\n")
+    (package / "stages.py").write_text(
+        "from stagepkg.helpers import double\n\n\ndef run():\n    return double(1)\n"
+    )
+    monkeypatch.syspath_prepend(str(tmp_path))
+    from stagepkg.stages import run
+
+    stage = Stage("double", run)
+    key = stage_key(stage)
+    assert stage_key(stage) == key
+    (package / "helpers.py").write_text("def double(x):\n    return x + x\n")
+    assert stage_key(stage) != key
+
+
+def test_stages_are_ordered_by_what_they_require():
+    # the outputs and inputs don't overlap as patterns, yet c runs after b
+    stages = [
+        Stage("c", print, inputs=["b/out.csv"], requires=["b"]),
+        Stage("b", print, outputs=["b/*.csv"], requires=["a"]),
+        Stage("a", print, outputs=["a/*.csv"]),
+    ]
+    assert [s.name for s in sort_stages(stages)] == ["a", "b", "c"]
+
+
+def test_unknown_required_stage():
+    with pytest.raises(ValueError, match="unknown stage: b"):
+        dependencies([Stage("a", print, requires=["b"])])
+
+
+def test_stages_that_can_run_in_parallel_get_the_workers():
+    from run import get_stages
+
+    stages = {stage.name: stage for stage in get_stages(workers=3)}
+    for name in ["process", "models", "reporting"]:
+        assert stages[name].options["workers"] == 3
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import glob
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import pytest
+from src import reporting
+from src.feature_engineering import load_clip_limits
+from src.prospect_querying import prospect_features, query_prospects, read_rows
+from src.reporting import load_region, query_neighbors
+from src.storage import read_frame
+
+
+@pytest.fixture(scope="module")
+def engineered(pipeline_dir):
+    # the raw filings and engineered features of the pipeline, with the clip
+    # limits and checkpoints it saved
+    raw = pd.concat(
+        [
+            read_rows(path)
+            for path in sorted(glob.glob(f"{pipeline_dir}/data/raw/SEC/*/*.csv"))
+        ],
+        ignore_index=True,
+    )
+    unscaled = read_frame(
+        f"{pipeline_dir}/data/engineered/unscaled_features",
+        schema="unscaled_features",
+    )
+    saved = load_clip_limits(f"{pipeline_dir}/data/engineered/clip_limits.npz")
+    return raw, unscaled, saved
+
+
+def test_advisors_in_the_model_match_their_features(engineered):
+    # re-querying advisors from their raw filings, one at a time and together,
+    # gives the rows the pipeline engineered for them
+    raw, unscaled, (features, limits, checkpoints) = engineered
+    IDs = unscaled["1D"].astype(str).sample(200, random_state=0).tolist()
+    stored = unscaled.set_index(unscaled["1D"].astype(str))
+    for query in [[ID] for ID in IDs[:50]] + [IDs]:
+        prospects, X = prospect_features(
+            raw.loc[raw["1D"].isin(query), :], features, limits, checkpoints
+        )
+        assert sorted(prospects["1D"].astype(str)) == sorted(query)
+        expected = stored.loc[prospects["1D"].astype(str), features]
+        np.testing.assert_array_equal(X, expected.to_numpy())
+
+
+def test_filings_since_the_pipeline_count_as_of_its_last_checkpoint(engineered):
+    # an advisor that registered since the pipeline ran gets the features it
+    # would have had on its last day, while one without a recent filing is left
+    # out as it is in the pipeline
+    raw, unscaled, (features, limits, checkpoints) = engineered
+    ID = unscaled["1D"].astype(str).iloc[0]
+    filings = raw.loc[raw["1D"] == ID, :]
+    latest = pd.to_datetime(filings["DateSubmitted"]).idxmax()
+    moved = filings.loc[[latest], :].assign(
+        **{
+            "1D": "801-new",
+            "DateSubmitted": f"{checkpoints[0] + pd.DateOffset(months=2):%m/%d/%Y}",
+        }
+    )
+    on_last_day = moved.assign(DateSubmitted=f"{checkpoints[0]:%m/%d/%Y}")
+    _, X = prospect_features(moved, features, limits, checkpoints)
+    _, expected = prospect_features(on_last_day, features, limits, checkpoints)
+    np.testing.assert_array_equal(X, expected)
+
+    stale = moved.assign(
+        DateSubmitted=f"{checkpoints[0] - pd.DateOffset(years=2):%m/%d/%Y}"
+    )
+    with pytest.raises(ValueError, match="801-new"):
+        prospect_features(stale, features, limits, checkpoints)
+
+
+def test_query_prospects_finds_the_advisor_itself(engineered):
+    # an advisor in the model finds its own row, which is left out of its
+    # neighbors
+    raw, unscaled, _ = engineered
+    ID = unscaled["1D"].astype(str).iloc[0]
+    neighbors = query_prospects(raw.loc[raw["1D"] == ID, :], "full", 5)
+    assert len(neighbors) == 5
+    assert ID not in neighbors["neighbor_ID"].tolist()
+
+
+@pytest.mark.parametrize("region", ["Mideast", "full"])
+def test_query_prospects_in_global_mode(engineered, region):
+    # the full model filtered by region, so the region needs no model of its own:
+    # an advisor's neighbors are those query_neighbors finds for its row
+    raw, unscaled, _ = engineered
+    bundle = load_region("full")
+    ID = bundle.ids[bundle.postings["Mideast"][0]]
+    neighbors = query_prospects(raw.loc[raw["1D"] == ID, :], region, 5, "global")
+    expected = query_neighbors([ID], region, 6, mode="global")
+    expected = expected.loc[expected["neighbor_ID"] != ID, :].head(5)
+    assert neighbors["neighbor_ID"].tolist() == expected["neighbor_ID"].tolist()
+    np.testing.assert_allclose(neighbors["distance"], expected["distance"], atol=1e-5)
+
+
+def test_query_prospects_in_global_mode_needs_no_regional_bundle(
+    engineered, monkeypatch
+):
+    # as after a global build, where only the full model's bundle exists
+    raw, _, _ = engineered
+    bundle = load_region("full")
+    ID = bundle.ids[bundle.postings["Plains"][0]]
+    load_bundle = reporting.load_bundle
+
+    def full_only(region):
+        if region != "full":
+            raise FileNotFoundError(f"serving_{region}.npz")
+        return load_bundle(region)
+
+    monkeypatch.setattr(reporting, "load_bundle", full_only)
+    monkeypatch.setattr(reporting, "region_cache", OrderedDict())
+    neighbors = query_prospects(raw.loc[raw["1D"] == ID, :], "Plains", 5, "global")
+    assert len(neighbors) == 5
+    with pytest.raises(FileNotFoundError):
+        query_prospects(raw.loc[raw["1D"] == ID, :], "Plains", 5)
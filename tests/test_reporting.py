@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+import sys
+from collections import OrderedDict
+import numpy as np
+import pytest
+from joblib import load
+from sklearn.neighbors import NearestNeighbors
+from src import profiling, reporting
+from src.reporting import (
+    filtered_kneighbors,
+    format_df,
+    get_id_name_state,
+    load_region,
+    overfetch_kneighbors,
+    query_neighbors,
+    report_cols,
+)
+from src.storage import read_frame
+
+
+@pytest.fixture
+def points():
+    rng = np.random.default_rng(0)
+    X_all = rng.normal(size=(500, 4))
+    candidates = np.flatnonzero(rng.random(500) < 0.2)
+    return X_all, candidates
+
+
+@pytest.mark.parametrize("overfetch", [2, 0.1])
+def test_overfetch_kneighbors_matches_filtered_search(points, overfetch):
+    # with an exact index the over-fetched neighbors are the exact ones, also for
+    # the rows that fetched too few and fell back to a filtered search
+    X_all, candidates = points
+    model = NearestNeighbors().fit(X_all)
+    X = X_all[:50]
+    expected = filtered_kneighbors(X, candidates, 10, X_all[candidates])
+    found = overfetch_kneighbors(model, X, candidates, 10, X_all, overfetch)
+    np.testing.assert_allclose(found[0], expected[0])
+    np.testing.assert_array_equal(found[1], expected[1])
+
+
+def test_global_mode_uses_the_backend(pipeline_dir, monkeypatch):
+    bundle = load_region("full", "ivf")
+    region = "Mideast"
+    ids = bundle.ids[bundle.postings[region][:5]].tolist()
+
+    calls = list()
+    kneighbors = bundle.model.kneighbors
+
+    def counted(X, k):
+        calls.append(k)
+        return kneighbors(X, k)
+
+    monkeypatch.setattr(bundle.model, "kneighbors", counted)
+    neighbors = query_neighbors(ids, region, 10, backend="ivf", mode="global")
+    assert len(calls) == 1
+    assert len(neighbors) == 50
+    assert set(neighbors["neighbor_ID"]) <= set(bundle.ids[bundle.postings[region]])
+
+
+def test_global_mode_without_region_labels(pipeline_dir, monkeypatch):
+    bundle = load_region("full")._replace(postings=None)
+    monkeypatch.setattr(reporting, "load_region", lambda region, backend: bundle)
+    with pytest.raises(ValueError, match="region_full.npy"):
+        query_neighbors(bundle.ids[:1].tolist(), "Mideast", 5, mode="global")
+
+
+def test_dashboard_data_records_each_region_step(pipeline_dir):
+    # the neighbors of each region are timed as well as their writes
+    names = [record["name"] for record in profiling.records]
+    for name in ["full", "full/neighbors", "full/sqlite write", "Mideast/neighbors"]:
+        assert name in names
+    for name in ["clean", "resample", "finalize"]:
+        assert name in names
+
+
+def test_foreign_advisors_with_categorical_states(pipeline_dir):
+    # the states are categoricals, which can't take "Foreign" until they are
+    # turned back into objects
+    df = read_frame(
+        f"{pipeline_dir}/data/reporting/reporting_data",
+        columns=report_cols + ["region"],
+        schema="reporting_data",
+    )
+    assert df["1F1-State"].dtype == "category"
+    foreign = df["1F1-State"].isna()
+    assert foreign.any()
+
+    formatted = format_df(df)
+    assert (formatted.loc[foreign, "State"] == "Foreign").all()
+    assert formatted["State"].notna().all()
+
+    lookup = get_id_name_state(df, "full")
+    foreign_IDs = set(lookup.loc[lookup["Name"].str.endswith(" (Foreign)"), "ID"])
+    assert foreign_IDs == set(df.loc[foreign, "1D"]) & set(lookup["ID"])
+    region = df.loc[foreign, "region"].iloc[0]
+    lookup = get_id_name_state(df, region)
+    assert set(lookup["ID"]) <= set(df.loc[df["region"] == region, "1D"])
+
+
+def test_exact_queries_use_the_serving_bundle(pipeline_dir):
+    # exact neighbors come from the NumPy engine (no model is loaded) and match
+    # the sklearn model
+    bundle = load_region("Mideast")
+    assert bundle.model is None
+    ids = bundle.ids[:50].tolist()
+    neighbors = query_neighbors(ids, "Mideast", 21)
+    model = load(f"{pipeline_dir}/models/model_Mideast.pkl")
+    distances, expected = model.kneighbors(bundle.X_reduced[:50], 21)
+    np.testing.assert_allclose(neighbors["distance"], distances.ravel(), atol=1e-5)
+    expected = bundle.ids[expected.ravel()]
+    np.testing.assert_array_equal(neighbors["neighbor_ID"], expected)
+
+
+def test_querying_does_not_import_sklearn():
+    # (in a process of its own, since the tests have imported it already)
+    code = "import sys, src.reporting, src.batch_querying; "
+    code += "print('sklearn' in sys.modules)"
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        check=True,
+    )
+    assert output.stdout.strip() == "False"
+
+
+def test_exact_region_loads_without_the_model(pipeline_dir, monkeypatch):
+    # the points are memory-mapped from the serving bundle and no pickle is read
+    def unpickle(path):
+        raise AssertionError(f"{path} was unpickled")
+
+    monkeypatch.setattr(reporting, "load", unpickle)
+    monkeypatch.setattr(reporting, "region_cache", OrderedDict())
+    bundle = load_region("Plains")
+    assert bundle.model is None
+    assert isinstance(bundle.X_reduced, np.memmap)
+    assert isinstance(bundle.X, np.memmap)
+    assert len(query_neighbors(bundle.ids[:3].tolist(), "Plains", 5)) == 15
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import tracemalloc
+import numpy as np
+import pytest
+from joblib import load
+from src import serving
+from src.serving import kneighbors, load_bundle, verify
+
+
+@pytest.mark.parametrize("region", ["full", "Mideast", "Plains"])
+def test_kneighbors_matches_sklearn_model(pipeline_dir, region):
+    assert len(verify(region, k=21)) == 0
+
+
+def test_kneighbors_of_new_points(pipeline_dir):
+    # points that aren't in the bundle, against the sklearn model directly
+    bundle = load_bundle("full")
+    model = load(f"{pipeline_dir}/models/model_full.pkl")
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(50, bundle.points.shape[1]))
+    distances, neighbors = kneighbors(bundle, X, 10, chunk_size=16)
+    expected_distances, expected_neighbors = model.kneighbors(X, 10)
+    np.testing.assert_allclose(distances, expected_distances, atol=1e-5)
+    np.testing.assert_array_equal(neighbors, expected_neighbors)
+
+
+def test_verify_compares_the_last_neighbor(pipeline_dir, monkeypatch):
+    # a wrong k-th neighbor is reported unless it ties with the one after it
+    def wrong_last(bundle, X, k):
+        distances, neighbors = kneighbors(bundle, X, k)
+        neighbors[:, -1] = (neighbors[:, -1] + 1) % len(bundle.points)
+        return distances, neighbors
+
+    monkeypatch.setattr(serving, "kneighbors", wrong_last)
+    assert len(verify("full", k=5, n_queries=100)) > 90
+
+
+def test_kneighbors_does_not_copy_the_points(pipeline_dir):
+    # the points stay memory-mapped and a query allocates far less than a
+    # float64 copy of them
+    bundle = load_bundle("full")
+    assert isinstance(bundle.points, np.memmap)
+    np.testing.assert_allclose(
+        bundle.norms, (np.asarray(bundle.points, np.float64) ** 2).sum(axis=1), 1e-6
+    )
+    x = np.asarray(bundle.points[:1])
+    tracemalloc.start()
+    kneighbors(bundle, x, 21)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert peak < bundle.points.size * 8 / 2